@@ -17,48 +17,73 @@ def get_default_perspective_cam():
     return camera
 
 
+def get_vertex_scatter_buffers(batch):
+    # CSR of incident faces for every rendered vertex (vertex_ctr order), it only depends on the batch topology,
+    # so it is built once and shared by every render call on the same batch
+    if 'vertex_scatter' not in batch:
+        indices_quad = batch["indices_quad"]
+        num_vertices = batch["vertices"].shape[0] // batch["mvp"].shape[1]
+        corner_vertex_idx = indices_quad.reshape(-1).long()
+        corner_face_idx = torch.arange(indices_quad.shape[0], device=indices_quad.device).repeat_interleave(indices_quad.shape[1])
+        faces_by_vertex = corner_face_idx[torch.argsort(corner_vertex_idx)]
+        valence = torch.bincount(corner_vertex_idx, minlength=num_vertices)
+        vertex_ptr = torch.cumsum(valence, 0) - valence
+        render_valence = valence[batch['vertex_ctr']]
+        indptr = torch.nn.functional.pad(torch.cumsum(render_valence, 0), (1, 0))
+        row = torch.repeat_interleave(torch.arange(render_valence.shape[0], device=indptr.device), render_valence)
+        gather_face_idx = faces_by_vertex[vertex_ptr[batch['vertex_ctr']][row] + torch.arange(row.shape[0], device=indptr.device) - indptr[row]]
+        # index_select takes int32 indices, segment_csr needs int64 indptr
+        batch['vertex_scatter'] = (gather_face_idx.int(), indptr)
+    return batch['vertex_scatter']
+
+
+def scatter_face_attributes_to_vertices(face_attributes, batch):
+    gather_face_idx, indptr = get_vertex_scatter_buffers(batch)
+    return torch_scatter.segment_csr(face_attributes.index_select(0, gather_face_idx), indptr, reduce='mean')
+
+
 def to_vertex_colors_scatter(face_colors, batch):
     assert face_colors.shape[1] == 3
-    vertex_colors = torch.zeros((batch["vertices"].shape[0] // batch["mvp"].shape[1], face_colors.shape[1] + 1)).to(face_colors.device)
-    torch_scatter.scatter_mean(face_colors.unsqueeze(1).expand(-1, 4, -1).reshape(-1, 3), batch["indices_quad"].reshape(-1).long(), dim=0, out=vertex_colors)
-    vertex_colors[:, 3] = 1
-    return vertex_colors[batch['vertex_ctr'], :]
+    vertex_colors = scatter_face_attributes_to_vertices(face_colors, batch)
+    return torch.cat([vertex_colors, torch.ones_like(vertex_colors[:, :1])], dim=1)
 
 
 def to_vertex_shininess_scatter(face_shininess, batch):
     assert face_shininess.shape[1] == 1
-    vertex_shininess = torch.zeros((batch["vertices"].shape[0] // batch["mvp"].shape[1], face_shininess.shape[1])).to(face_shininess.device)
-    torch_scatter.scatter_mean(face_shininess.unsqueeze(1).expand(-1, 4, -1).reshape(-1, 1), batch["indices_quad"].reshape(-1).long(), dim=0, out=vertex_shininess)
-    return vertex_shininess[batch['vertex_ctr'], :]
+    return scatter_face_attributes_to_vertices(face_shininess, batch)
+
+
+# tensors only read on the host (e.g. rasterizer ranges), moving them to the device forces a sync on every use
+cpu_keys = {'ranges'}
 
 
 def to_device(batch, device):
     for k in batch.keys():
-        if isinstance(batch[k], torch.Tensor):
-            batch[k] = batch[k].to(device)
+        if isinstance(batch[k], torch.Tensor) and k not in cpu_keys:
+            batch[k] = batch[k].to(device, non_blocking=True)
     if 'graph_data' in batch:
         for k in batch['graph_data'].keys():
             if isinstance(batch['graph_data'][k], torch.Tensor):
-                batch['graph_data'][k] = batch['graph_data'][k].to(device)
+                batch['graph_data'][k] = batch['graph_data'][k].to(device, non_blocking=True)
             elif isinstance(batch['graph_data'][k], list):
                 for m in range(len(batch['graph_data'][k])):
                     if isinstance(batch['graph_data'][k][m], torch.Tensor):
-                        batch['graph_data'][k][m] = batch['graph_data'][k][m].to(device)
+                        batch['graph_data'][k][m] = batch['graph_data'][k][m].to(device, non_blocking=True)
     if 'sparse_data' in batch:
-        batch['sparse_data'] = [batch['sparse_data'][0].cuda(), batch['sparse_data'][1].cuda(), batch['sparse_data'][2].cuda()]
+        batch['sparse_data'] = [batch['sparse_data'][0].cuda(non_blocking=True), batch['sparse_data'][1].cuda(non_blocking=True), batch['sparse_data'][2].cuda(non_blocking=True)]
     if 'sparse_data_064' in batch:
-        batch['sparse_data_064'] = [batch['sparse_data_064'][0].cuda(), batch['sparse_data_064'][1].cuda()]
+        batch['sparse_data_064'] = [batch['sparse_data_064'][0].cuda(non_blocking=True), batch['sparse_data_064'][1].cuda(non_blocking=True)]
     return batch
 
 
 def to_device_graph_data(batch, device):
     for k in batch.keys():
         if isinstance(batch[k], torch.Tensor):
-            batch[k] = batch[k].to(device)
+            batch[k] = batch[k].to(device, non_blocking=True)
         elif isinstance(batch[k], list):
             for m in range(len(batch[k])):
                 if isinstance(batch[k][m], torch.Tensor):
-                    batch[k][m] = batch[k][m].to(device)
+                    batch[k][m] = batch[k][m].to(device, non_blocking=True)
     return batch
 
 
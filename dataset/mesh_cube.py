@@ -108,11 +108,11 @@ class FaceGraphMeshDataset(torch.utils.data.Dataset):
         mesh.export(output_dir / f"{name}_{output_suffix}.obj")
 
     def to_image(self, face_colors, level_mask):
-        batch_size = level_mask.max() + 1
+        batch_size = int(level_mask.max()) + 1
         image = torch.zeros((batch_size, 3, self.mesh_resolution, self.mesh_resolution), device=face_colors.device)
-        indices_dest_i = torch.tensor(self.indices_dest_i * batch_size, device=face_colors.device).long()
-        indices_dest_j = torch.tensor(self.indices_dest_j * batch_size, device=face_colors.device).long()
-        indices_src = torch.tensor(self.indices_src * batch_size, device=face_colors.device).long()
+        indices_dest_i = self.indices_dest_i.to(face_colors.device, non_blocking=True).repeat(batch_size)
+        indices_dest_j = self.indices_dest_j.to(face_colors.device, non_blocking=True).repeat(batch_size)
+        indices_src = self.indices_src.to(face_colors.device, non_blocking=True).repeat(batch_size)
         image[level_mask, :, indices_dest_i, indices_dest_j] = face_colors[indices_src + level_mask * len(self.indices_src), :]
         return image
 
@@ -136,3 +136,7 @@ class FaceGraphMeshDataset(torch.utils.data.Dataset):
             self.indices_dest_i.append(i)
             self.indices_dest_j.append(j)
             self.indices_src.append(v_idx)
+        # tiled per batch on the device in to_image instead of replicating python lists on every call
+        self.indices_dest_i = torch.from_numpy(np.array(self.indices_dest_i, dtype=np.int64))
+        self.indices_dest_j = torch.from_numpy(np.array(self.indices_dest_j, dtype=np.int64))
+        self.indices_src = torch.from_numpy(np.array(self.indices_src, dtype=np.int64))
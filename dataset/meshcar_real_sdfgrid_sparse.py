@@ -210,8 +210,11 @@ class Collater(object):
         elif isinstance(elem, str):
             return batch
         elif isinstance(elem, Mapping):
-            retdict = {'sparse_data': ME.utils.sparse_collate([d["x_loc_128"] for d in batch], [d["x_val"] for d in batch], [d["y_val"] for d in batch]),
-                       'sparse_data_064': ME.utils.sparse_collate([d["x_loc_064"] for d in batch], [torch.zeros_like(d["x_loc_064"]) for d in batch])}
+            sparse_data = ME.utils.sparse_collate([d["x_loc_128"] for d in batch], [d["x_val"] for d in batch], [d["y_val"] for d in batch])
+            sparse_data_064 = ME.utils.sparse_collate([d["x_loc_064"] for d in batch], [torch.zeros_like(d["x_loc_064"]) for d in batch])
+            # coordinates are used as int64 by the generator and the raycaster, cast once here instead of on the device every step
+            retdict = {'sparse_data': (sparse_data[0].long(), *sparse_data[1:]),
+                       'sparse_data_064': (sparse_data_064[0].long(), *sparse_data_064[1:])}
             for key in elem:
                 if 'cam_position' in elem:
                     retdict['view_vector'] = self.cat_collate([(d['vertices'].unsqueeze(0).expand(d['cam_position'].shape[0], -1, -1) - d['cam_position'].unsqueeze(1).expand(-1, d['vertices'].shape[0], -1)).reshape(-1, 3) for d in batch])
@@ -7,6 +7,12 @@ def clamp_gain(x: torch.Tensor, g: float, c: float):
     return torch.clamp(x * g, -c, c)
 
 
+@torch.jit.script
+def bias_lrelu_clamp_gain(x: torch.Tensor, noise: torch.Tensor, bias: torch.Tensor, g: float, c: float):
+    # noise, bias, leaky relu, gain and clamp as one fusable elementwise chain
+    return torch.clamp(torch.nn.functional.leaky_relu(x + noise + bias.unsqueeze(0), 0.2) * g, -c, c)
+
+
 def normalize_2nd_moment(x, dim=1, eps=1e-8):
     return x * (x.square().mean(dim=dim, keepdim=True) + eps).rsqrt()
 
@@ -1,6 +1,5 @@
 import torch
 import numpy as np
-from torchmetrics import MeanMetric
 
 from model import SmoothUpsample, SmoothDownsample, identity
 
@@ -75,7 +74,9 @@ class AugmentPipe(torch.nn.Module):
         super().__init__()
 
         self.register_buffer('p', torch.ones([1]).float() * start_p)  # Overall multiplier for augmentation probability.
-        self.p_real_signs = MeanMetric()
+        # sign statistics stay on the device and are only reduced in heuristic_update,
+        # plain tensors rather than buffers so ddp does not overwrite them with rank zero's
+        self.real_sign_sum, self.real_sign_count = None, None
 
         self.ada_target = target
         self.batch_size = batch_size
@@ -119,12 +120,21 @@ class AugmentPipe(torch.nn.Module):
         self.heuristic_update = self.heuristic_update if not fixed else self.heuristic_update_no_op
 
     def accumulate_real_sign(self, sign):
-        self.p_real_signs.update(sign)
+        if self.real_sign_sum is None:
+            self.real_sign_sum, self.real_sign_count = torch.zeros([], device=sign.device), torch.zeros([], device=sign.device)
+        self.real_sign_sum.add_(sign.sum())
+        self.real_sign_count.add_(sign.numel())
 
     def heuristic_update(self):
-        adjust = torch.sign(self.p_real_signs.compute() - self.ada_target) * (self.batch_size * self.ada_interval) / (self.ada_kimg * 1000)
+        if self.real_sign_sum is None:
+            return
+        real_sign_stats = torch.stack([self.real_sign_sum, self.real_sign_count])
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(real_sign_stats)
+        adjust = torch.sign(real_sign_stats[0] / real_sign_stats[1] - self.ada_target) * (self.batch_size * self.ada_interval) / (self.ada_kimg * 1000)
         self.p.copy_((self.p + adjust).max(torch.tensor(0, device=self.p.device).float()).min(torch.tensor(1.0, device=self.p.device).float()))
-        self.p_real_signs.reset()
+        self.real_sign_sum.zero_()
+        self.real_sign_count.zero_()
 
     def forward(self, images, disable_grid_sampling=False):
         device = images.device
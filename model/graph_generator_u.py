@@ -1,6 +1,7 @@
 import torch
+import torch.utils.checkpoint
 import numpy as np
-from model import activation_funcs, FullyConnectedLayer, clamp_gain, normalize_2nd_moment
+from model import activation_funcs, FullyConnectedLayer, clamp_gain, normalize_2nd_moment, bias_lrelu_clamp_gain
 from model.graph import create_faceconv_input, SmoothUpsample, modulated_face_conv
 
 
@@ -47,7 +48,7 @@ class SynthesisNetwork(torch.nn.Module):
                                    color_channels=color_channels, last_block=blk_idx == (len(self.block_pow_2[1:]) - 1))
             self.blocks.append(block)
 
-    def forward(self, graph_data, ws, shape, noise_mode='random'):
+    def forward(self, graph_data, ws, shape, noise_mode='random', use_checkpoint=False):
         split_ws = [ws[:, 0:2, :]] + [ws[:, 2 * n + 1: 2 * n + 4, :] for n in range(len(self.block_pow_2) - 1)]
         neighborhoods = [graph_data['face_neighborhood']] + graph_data['sub_neighborhoods']
         appended_pool_maps = [None] + graph_data['pool_maps']
@@ -63,7 +64,12 @@ class SynthesisNetwork(torch.nn.Module):
                                                          [graph_data['is_pad'][block_level + 1], graph_data['is_pad'][block_level]], \
                                                          [graph_data['pads'][block_level + 1], graph_data['pads'][block_level]], \
                                                          [appended_pool_maps[block_level + 1], appended_pool_maps[block_level]]
-            x, face_colors = self.blocks[i](sub_neighborhoods, is_pad, pads, pool_maps, x, face_colors, split_ws[i + 1], shape[len(shape) - 1 - i], noise_mode)
+            block_args = (sub_neighborhoods, is_pad, pads, pool_maps, x, face_colors, split_ws[i + 1], shape[len(shape) - 1 - i], noise_mode)
+            if use_checkpoint and torch.is_grad_enabled():
+                # activations are recomputed in backward, only usable with .backward() and not with autograd.grad
+                x, face_colors = torch.utils.checkpoint.checkpoint(self.blocks[i], *block_args)
+            else:
+                x, face_colors = self.blocks[i](*block_args)
 
         return face_colors
 
@@ -147,6 +153,7 @@ class SynthesisLayer(torch.nn.Module):
         self.resampler = resampler
         self.activation = activation_funcs[activation]['fn']
         self.activation_gain = activation_funcs[activation]['def_gain']
+        self.fused_epilogue = activation == 'lrelu'
         self.affine = FullyConnectedLayer(w_dim, in_channels, bias_init=1)
         self.weight = torch.nn.Parameter(torch.randn([out_channels, in_channels, 1,  kernel_size ** 2]))
 
@@ -168,6 +175,8 @@ class SynthesisLayer(torch.nn.Module):
         x = modulated_face_conv(x=x, weight=self.weight, styles=styles)
         if self.resampler is not None:
             x = self.resampler(x, face_neighborhood[1], face_is_pad[1], pad_size[1], pool_map)
+        if self.fused_epilogue:
+            return bias_lrelu_clamp_gain(x, noise, self.bias, self.activation_gain * gain, 256 * gain)
         x = x + noise
 
         return clamp_gain(self.activation(x + self.bias[None, :]), self.activation_gain * gain, 256 * gain)
@@ -199,7 +208,7 @@ class MappingNetwork(torch.nn.Module):
         if num_ws is not None and w_avg_beta is not None:
             self.register_buffer('w_avg', torch.zeros([w_dim]))
 
-    def forward(self, z, c=None, truncation_psi=1, truncation_cutoff=None, skip_w_avg_update=False):
+    def forward(self, z, c=None, truncation_psi=1, truncation_cutoff=None, skip_w_avg_update=False, w_avg_batch_size=None):
         # Embed, normalize, and concat inputs.
         x = normalize_2nd_moment(z)
 
@@ -211,9 +220,9 @@ class MappingNetwork(torch.nn.Module):
         for idx in range(self.num_layers):
             x = self.layers[idx](x)
 
-        # Update moving average of W.
+        # Update moving average of W (optionally from the leading w_avg_batch_size samples only).
         if self.w_avg_beta is not None and self.training and not skip_w_avg_update:
-            self.w_avg.copy_(x.detach().mean(dim=0).lerp(self.w_avg, self.w_avg_beta))
+            self.w_avg.copy_(x[:w_avg_batch_size].detach().mean(dim=0).lerp(self.w_avg, self.w_avg_beta))
 
         # Broadcast.
         if self.num_ws is not None:
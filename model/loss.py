@@ -3,9 +3,15 @@ import numpy as np
 from torch import nn
 
 
+@torch.jit.script
+def softplus_mean(x: torch.Tensor, sign: float):
+    return torch.nn.functional.softplus(x * sign).mean()
+
+
 def compute_gradient_penalty(x, d):
     gradients = torch.autograd.grad(outputs=[d.sum()], inputs=[x], create_graph=True, only_inputs=True)[0]
-    r1_penalty = gradients.square().sum([1, 2, 3]).mean()
+    # sum of squares over the whole batch in a single reduction
+    r1_penalty = gradients.square().sum() / gradients.shape[0]
     return r1_penalty / 2
 
 
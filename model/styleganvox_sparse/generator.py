@@ -243,7 +243,7 @@ class MappingNetwork(torch.nn.Module):
         if num_ws is not None and w_avg_beta is not None:
             self.register_buffer('w_avg', torch.zeros([w_dim]))
 
-    def forward(self, z, truncation_psi=1, truncation_cutoff=None, skip_w_avg_update=False):
+    def forward(self, z, truncation_psi=1, truncation_cutoff=None, skip_w_avg_update=False, w_avg_batch_size=None):
         # Embed, normalize, and concat inputs.
         x = normalize_2nd_moment(z)
 
@@ -251,9 +251,9 @@ class MappingNetwork(torch.nn.Module):
         for idx in range(self.num_layers):
             x = self.layers[idx](x)
 
-        # Update moving average of W.
+        # Update moving average of W (optionally from the leading w_avg_batch_size samples only).
         if self.w_avg_beta is not None and self.training and not skip_w_avg_update:
-            self.w_avg.copy_(x.detach().mean(dim=0).lerp(self.w_avg, self.w_avg_beta))
+            self.w_avg.copy_(x[:w_avg_batch_size].detach().mean(dim=0).lerp(self.w_avg, self.w_avg_beta))
 
         # Broadcast.
         if self.num_ws is not None:
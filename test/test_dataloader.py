@@ -77,13 +77,21 @@ def test_view_angles_real(config):
         save_image(batch['real'], f"runs/images_real/test_view_{batch_idx:04d}.png", nrow=8, value_range=(-1, 1), normalize=True)
 
 
+def get_mask_bbox(mask_path):
+    from PIL import Image
+    # None for an all-zero mask, without materializing and summing the whole array
+    return Image.open(mask_path).getbbox()
+
+
 @hydra.main(config_path='../config', config_name='stylegan2')
 def test_masks(config):
-    import numpy as np
-    from PIL import Image
-    for mask in tqdm(list(Path(config.mask_path).iterdir())):
-        if np.array(Image.open(mask)).sum() == 0:
-            print(mask)
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+    masks = list(Path(config.mask_path).iterdir())
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for mask, bbox in zip(masks, tqdm(executor.map(get_mask_bbox, masks, chunksize=64), total=len(masks))):
+            if bbox is None:
+                print(mask)
 
 
 @hydra.main(config_path='../config', config_name='stylegan2')
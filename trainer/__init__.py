@@ -82,7 +82,7 @@ def create_trainer(name, config):
         # config.val_check_interval *= gpu_count
         trainer = Trainer(gpus=-1,
                           accelerator='ddp',
-                          plugins=DDPPlugin(find_unused_parameters=True),
+                          plugins=DDPPlugin(find_unused_parameters=True, bucket_cap_mb=200, gradient_as_bucket_view=True),
                           num_sanity_val_steps=config.sanity_steps,
                           max_epochs=config.max_epoch,
                           limit_val_batches=config.val_check_percent,
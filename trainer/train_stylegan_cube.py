@@ -1,11 +1,15 @@
 import math
+import random
 import shutil
+import tempfile
+from contextlib import nullcontext
 from pathlib import Path
 
 import torch
 import hydra
 import pytorch_lightning as pl
 from pytorch_lightning.utilities import rank_zero_only
+from torch.nn.parallel import DistributedDataParallel
 from torch_ema import ExponentialMovingAverage
 from torchvision.utils import save_image
 from cleanfid import fid
@@ -16,8 +20,9 @@ from model.augment import AugmentPipe
 from model.differentiable_renderer import DifferentiableRenderer
 from model.graph_generator import Generator
 from model.discriminator import Discriminator
-from model.loss import PathLengthPenalty, compute_gradient_penalty
+from model.loss import PathLengthPenalty, compute_gradient_penalty, softplus_mean
 from trainer import create_trainer
+from util.misc import save_jpegs, quantize_images, write_jpegs
 from util.timer import Timer
 
 torch.backends.cudnn.benchmark = True
@@ -32,7 +37,8 @@ class StyleGAN2Trainer(pl.LightningModule):
         self.save_hyperparameters(config)
         self.config = config
         self.G = Generator(config.latent_dim, config.latent_dim, config.num_mapping_layers, config.num_faces, 3)
-        self.D = Discriminator(config.image_size, 3)
+        # rendered images arrive as a channels-last view (NHWC raster permuted to NCHW), D uses the same layout so cuDNN consumes them without a copy
+        self.D = Discriminator(config.image_size, 3).to(memory_format=torch.channels_last)
         self.R = None
         self.augment_pipe = AugmentPipe(config.ada_start_p, config.ada_target, config.ada_interval, config.ada_fixed, config.batch_size)
         # print_module_summary(self.G, (torch.zeros(self.config.batch_size, self.config.latent_dim), ))
@@ -44,6 +50,11 @@ class StyleGAN2Trainer(pl.LightningModule):
         self.automatic_optimization = False
         self.path_length_penalty = PathLengthPenalty(0.01, 2)
         self.ema = None
+        self.compiled_D, self.compiled_augment_pipe = None, None
+        self.grid_z_chunks = None
+        self.val_loader = None
+        self.ema_stream = None
+        self.z_1, self.z_2, self.z_pl_1, self.z_pl_2 = None, None, None, None
 
     def configure_optimizers(self):
         g_opt = torch.optim.Adam(list(self.G.parameters()), lr=self.config.lr_g, betas=(0.0, 0.99), eps=1e-8)
@@ -60,8 +71,8 @@ class StyleGAN2Trainer(pl.LightningModule):
         g_opt = self.optimizers()[0]
         g_opt.zero_grad(set_to_none=True)
         fake, w = self.forward(batch)
-        p_fake = self.D(self.augment_pipe(self.render(fake, batch)))
-        gen_loss = torch.nn.functional.softplus(-p_fake).mean()
+        p_fake = self.discriminate(self.render(fake, batch))
+        gen_loss = softplus_mean(p_fake, -1.)
         self.manual_backward(gen_loss)
         log_gen_loss = gen_loss.item()
         g_opt.step()
@@ -83,15 +94,17 @@ class StyleGAN2Trainer(pl.LightningModule):
         d_opt.zero_grad(set_to_none=True)
 
         fake, _ = self.forward(batch)
-        p_fake = self.D(self.augment_pipe(self.render(fake.detach(), batch)))
-        fake_loss = torch.nn.functional.softplus(p_fake).mean()
-        self.manual_backward(fake_loss)
+        p_fake = self.discriminate(self.render(fake.detach(), batch))
+        fake_loss = softplus_mean(p_fake, 1.)
+        # gradients of the fake pass are all-reduced together with the real pass below
+        with self.no_grad_sync():
+            self.manual_backward(fake_loss)
 
-        p_real = self.D(self.augment_pipe(self.render(batch["y"], batch)))
+        p_real = self.discriminate(self.render(batch["y"], batch))
         self.augment_pipe.accumulate_real_sign(p_real.sign().detach())
 
         # Get discriminator loss
-        real_loss = torch.nn.functional.softplus(-p_real).mean()
+        real_loss = softplus_mean(p_real, -1.)
         self.manual_backward(real_loss)
 
         d_opt.step()
@@ -113,8 +126,18 @@ class StyleGAN2Trainer(pl.LightningModule):
         d_opt.step()
         self.log("rGP", gp, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
 
+    def discriminate(self, image):
+        if self.compiled_D is not None:
+            return self.compiled_D(self.compiled_augment_pipe(image))
+        return self.D(self.augment_pipe(image))
+
+    def no_grad_sync(self):
+        if isinstance(self.trainer.model, DistributedDataParallel):
+            return self.trainer.model.no_sync()
+        return nullcontext()
+
     def render(self, face_colors, batch):
-        rendered_color = self.R.render(batch['vertices'], batch['indices'], to_vertex_colors_scatter(face_colors, batch), batch["ranges"].cpu())
+        rendered_color = self.R.render(batch['vertices'], batch['indices'], to_vertex_colors_scatter(face_colors, batch), batch["ranges"])
         return rendered_color.permute((0, 3, 1, 2))
 
     def training_step(self, batch, batch_idx):
@@ -126,7 +149,15 @@ class StyleGAN2Trainer(pl.LightningModule):
 
         # torch.nn.utils.clip_grad_norm_(self.G.parameters(), max_norm=1.0)
 
-        self.ema.update(self.G.parameters())
+        # the EMA only reads G, so on cuda it runs on a side stream concurrently with the discriminator updates
+        if self.ema_stream is not None:
+            self.ema_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.ema_stream):
+                for tensor in list(self.G.parameters()) + self.ema.shadow_params:
+                    tensor.record_stream(self.ema_stream)
+                self.ema.update(self.G.parameters())
+        else:
+            self.ema.update(self.G.parameters())
 
         # optimize discriminator
 
@@ -136,6 +167,9 @@ class StyleGAN2Trainer(pl.LightningModule):
             self.d_regularizer(batch)
 
         self.execute_ada_heuristics()
+        # join before G is stepped again / EMA weights are read for validation
+        if self.ema_stream is not None:
+            torch.cuda.current_stream().wait_stream(self.ema_stream)
 
     def execute_ada_heuristics(self):
         if (self.global_step + 1) % self.config.ada_interval == 0:
@@ -145,38 +179,43 @@ class StyleGAN2Trainer(pl.LightningModule):
     def validation_step(self, batch, batch_idx):
         pass
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        return to_device(batch, device)
+
     @rank_zero_only
     def validation_epoch_end(self, _val_step_outputs):
-        with Timer("export_textures"):
-            odir_real, odir_fake, odir_samples, odir_textures = self.create_directories()
-            self.export_textures("", odir_textures, None)
-            self.ema.store(self.G.parameters())
-            self.ema.copy_to([p for p in self.G.parameters() if p.requires_grad])
-            self.export_textures("ema_", odir_textures, odir_fake)
-            self.ema.restore([p for p in self.G.parameters() if p.requires_grad])
-            latents = self.grid_z.split(self.config.batch_size)
-        with Timer("export_samples"):
-            for iter_idx, batch in enumerate(self.val_dataloader()):
-                batch = to_device(batch, self.device)
-                real_render = self.render(batch['y'], batch).cpu()
-                fake_render = self.render(self.G(batch['graph_data'], latents[iter_idx].to(self.device), noise_mode='const'), batch).cpu()
-                save_image(real_render, odir_samples / f"real_{iter_idx}.jpg", value_range=(-1, 1), normalize=True)
-                save_image(fake_render, odir_samples / f"fake_{iter_idx}.jpg", value_range=(-1, 1), normalize=True)
-                texture = self.get_face_colors_as_texture_maps(batch['y']).cpu()
-                for batch_idx in range(texture.shape[0]):
-                    save_image(texture[batch_idx], odir_real / f"{iter_idx}_{batch_idx}.jpg", value_range=(-1, 1), normalize=True)
-        fid_score = fid.compute_fid(str(odir_real), str(odir_fake), device=self.device, num_workers=0)
-        print(f'FID: {fid_score:.3f}')
-        kid_score = fid.compute_kid(str(odir_real), str(odir_fake), device=self.device, num_workers=0)
-        print(f'KID: {kid_score:.3f}')
-        self.log(f"fid", fid_score, on_step=False, on_epoch=True, prog_bar=False, logger=True, rank_zero_only=True, sync_dist=True)
-        self.log(f"kid", kid_score, on_step=False, on_epoch=True, prog_bar=False, logger=True, rank_zero_only=True, sync_dist=True)
-        print(f'FID: {fid_score:.3f} , KID: {kid_score:.3f}')
-        shutil.rmtree(odir_real.parent)
+        odir_real, odir_fake, odir_samples, odir_textures = self.create_directories()
+        try:
+            with Timer("export_textures"):
+                self.export_textures("", odir_textures, None)
+                self.ema.store(self.G.parameters())
+                self.ema.copy_to([p for p in self.G.parameters() if p.requires_grad])
+                self.export_textures("ema_", odir_textures, odir_fake)
+                self.ema.restore([p for p in self.G.parameters() if p.requires_grad])
+                latents = self.grid_z_chunks
+            with Timer("export_samples"):
+                for iter_idx, batch in enumerate(self.val_dataloader()):
+                    batch = to_device(batch, self.device)
+                    real_render = self.render(batch['y'], batch).cpu()
+                    fake_render = self.render(self.generate_inference(batch['graph_data'], latents[iter_idx]), batch).cpu()
+                    save_image(real_render, odir_samples / f"real_{iter_idx}.jpg", value_range=(-1, 1), normalize=True)
+                    save_image(fake_render, odir_samples / f"fake_{iter_idx}.jpg", value_range=(-1, 1), normalize=True)
+                    texture = self.get_face_colors_as_texture_maps(batch['y'])
+                    save_jpegs(texture, [odir_real / f"{iter_idx}_{batch_idx}.jpg" for batch_idx in range(texture.shape[0])])
+            fid_score = fid.compute_fid(str(odir_real), str(odir_fake), device=self.device, num_workers=0)
+            print(f'FID: {fid_score:.3f}')
+            kid_score = fid.compute_kid(str(odir_real), str(odir_fake), device=self.device, num_workers=0)
+            print(f'KID: {kid_score:.3f}')
+            self.log(f"fid", fid_score, on_step=False, on_epoch=True, prog_bar=False, logger=True, rank_zero_only=True, sync_dist=True)
+            self.log(f"kid", kid_score, on_step=False, on_epoch=True, prog_bar=False, logger=True, rank_zero_only=True, sync_dist=True)
+            print(f'FID: {fid_score:.3f} , KID: {kid_score:.3f}')
+        finally:
+            # the fid directory may live on tmpfs, it must not outlive a failed validation
+            shutil.rmtree(odir_real.parent)
 
     def get_mapped_latent(self, z, style_mixing_prob):
-        if torch.rand(()).item() < style_mixing_prob:
-            cross_over_point = int(torch.rand(()).item() * self.G.mapping.num_ws)
+        if random.random() < style_mixing_prob:
+            cross_over_point = int(random.random() * self.G.mapping.num_ws)
             w1 = self.G.mapping(z[0])[:, :cross_over_point, :]
             w2 = self.G.mapping(z[1], skip_w_avg_update=True)[:, cross_over_point:, :]
             return torch.cat((w1, w2), dim=1)
@@ -184,37 +223,54 @@ class StyleGAN2Trainer(pl.LightningModule):
             w = self.G.mapping(z[0])
             return w
 
+    def generate_inference(self, graph_data, z):
+        # evaluation only, the generator runs in bf16 and hands fp32 face colors to the renderer / texture export
+        with torch.cuda.amp.autocast(dtype=torch.bfloat16):
+            fake = self.G(graph_data, z, noise_mode='const')
+        return fake.float()
+
     def latent(self, limit_batch_size=False):
-        batch_size = self.config.batch_size if not limit_batch_size else self.config.batch_size // self.path_length_penalty.pl_batch_shrink
-        z1 = torch.randn(batch_size, self.config.latent_dim).to(self.device)
-        z2 = torch.randn(batch_size, self.config.latent_dim).to(self.device)
-        return z1, z2
+        z1, z2 = (self.z_1, self.z_2) if not limit_batch_size else (self.z_pl_1, self.z_pl_2)
+        return z1.normal_(), z2.normal_()
 
     def train_dataloader(self):
-        return GraphDataLoader(self.train_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, num_workers=self.config.num_workers)
+        return GraphDataLoader(self.train_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, **self.get_worker_kwargs())
 
     def val_dataloader(self):
-        return GraphDataLoader(self.val_set, self.config.batch_size, shuffle=True, drop_last=True, num_workers=self.config.num_workers)
+        if self.val_loader is None:
+            self.val_loader = GraphDataLoader(self.val_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, **self.get_worker_kwargs())
+        return self.val_loader
+
+    def get_worker_kwargs(self):
+        # workers persist across epochs instead of being re-forked
+        if self.config.num_workers == 0:
+            return {'num_workers': 0}
+        return {'num_workers': self.config.num_workers, 'persistent_workers': True, 'prefetch_factor': 4}
 
     def export_textures(self, prefix, output_dir_vis, output_dir_fid):
-        vis_generated_images = []
-        for iter_idx, latent in enumerate(self.grid_z.split(self.config.batch_size)):
-            latent = latent.to(self.device)
-            graph_data = to_device_graph_data(self.eval_graph_data, self.device)
-            fake = self.G(graph_data, latent, noise_mode='const')
-            fake_texture = self.get_face_colors_as_texture_maps(fake).cpu()
+        vis_generated_images, fid_generated_images = [], []
+        for iter_idx, latent in enumerate(self.grid_z_chunks):
+            fake = self.generate_inference(self.eval_graph_data, latent)
+            fake_texture = self.get_face_colors_as_texture_maps(fake)
             if output_dir_fid is not None:
-                for batch_idx in range(fake_texture.shape[0]):
-                    save_image(fake_texture[batch_idx], output_dir_fid / f"{iter_idx}_{batch_idx}.jpg", value_range=(-1, 1), normalize=True)
+                fid_generated_images.append(quantize_images(fake_texture))
             if iter_idx < self.config.num_vis_images // self.config.batch_size:
-                vis_generated_images.append(fake_texture)
+                vis_generated_images.append(fake_texture.cpu())
+        if output_dir_fid is not None:
+            fid_generated_images = torch.cat(fid_generated_images, dim=0)
+            write_jpegs(fid_generated_images, [output_dir_fid / f"{image_idx // self.config.batch_size}_{image_idx % self.config.batch_size}.jpg" for image_idx in range(fid_generated_images.shape[0])])
         torch.cuda.empty_cache()
         vis_generated_images = torch.cat(vis_generated_images, dim=0)
         save_image(vis_generated_images, output_dir_vis / f"{prefix}{self.global_step:06d}.png", nrow=int(math.sqrt(vis_generated_images.shape[0])), value_range=(-1, 1), normalize=True)
 
     def create_directories(self):
-        output_dir_fid_real = Path(f'runs/{self.config.experiment}/fid/real')
-        output_dir_fid_fake = Path(f'runs/{self.config.experiment}/fid/fake')
+        # FID images are written and deleted every validation, keep them in RAM when tmpfs is available
+        if Path('/dev/shm').is_dir():
+            output_dir_fid = Path(tempfile.mkdtemp(prefix=f'{self.config.experiment}_fid_', dir='/dev/shm'))
+        else:
+            output_dir_fid = Path(f'runs/{self.config.experiment}/fid')
+        output_dir_fid_real = output_dir_fid / 'real'
+        output_dir_fid_fake = output_dir_fid / 'fake'
         output_dir_samples = Path(f'runs/{self.config.experiment}/images/')
         output_dir_textures = Path(f'runs/{self.config.experiment}/textures/')
         for odir in [output_dir_fid_real, output_dir_fid_fake, output_dir_samples, output_dir_textures]:
@@ -227,21 +283,33 @@ class StyleGAN2Trainer(pl.LightningModule):
         return face_colors_as_texture_map
 
     def get_level_mask(self, face_colors):
-        level_mask = torch.tensor(list(range(self.config.batch_size))).long().to(face_colors.device)
-        level_mask = level_mask.unsqueeze(-1).expand(-1, face_colors.shape[0] // self.config.batch_size).reshape(-1)
-        return level_mask
+        return torch.arange(self.config.batch_size, device=face_colors.device).repeat_interleave(face_colors.shape[0] // self.config.batch_size)
 
     def on_train_start(self):
         if self.ema is None:
             self.ema = ExponentialMovingAverage(self.G.parameters(), 0.995)
+        if self.ema_stream is None and self.device.type == 'cuda':
+            self.ema_stream = torch.cuda.Stream(device=self.device)
         if self.R is None:
             self.R = DifferentiableRenderer(self.config.image_size)
+        if self.z_1 is None:
+            # refilled in-place every step, plain tensors so ddp does not broadcast them from rank zero
+            pl_batch_size = self.config.batch_size // self.path_length_penalty.pl_batch_shrink
+            self.z_1, self.z_2 = [torch.empty(self.config.batch_size, self.config.latent_dim, device=self.device) for _ in range(2)]
+            self.z_pl_1, self.z_pl_2 = [torch.empty(pl_batch_size, self.config.latent_dim, device=self.device) for _ in range(2)]
+        if self.config.compile and self.compiled_D is None:
+            # forwards only, the double backward of R1 stays eager
+            self.compiled_D = torch.compile(self.D.forward)
+            self.compiled_augment_pipe = torch.compile(self.augment_pipe.forward)
 
     def on_validation_start(self):
         if self.ema is None:
             self.ema = ExponentialMovingAverage(self.G.parameters(), 0.995)
         if self.R is None:
             self.R = DifferentiableRenderer(self.config.image_size)
+        if self.grid_z_chunks is None:
+            self.grid_z_chunks = self.grid_z.to(self.device).split(self.config.batch_size)
+            self.eval_graph_data = to_device_graph_data(self.eval_graph_data, self.device)
 
 
 @hydra.main(config_path='../config', config_name='stylegan2')
@@ -6,11 +6,15 @@ import torch
 import hydra
 import pytorch_lightning as pl
 from pytorch_lightning.utilities import rank_zero_only
+try:
+    from torch.optim._multi_tensor import Adam as MultiTensorAdam
+except ImportError:
+    from torch.optim import Adam as MultiTensorAdam
 from torch.utils.data import DataLoader
 from torch_ema import ExponentialMovingAverage
 from torchvision.utils import save_image
-from cleanfid import fid
 import random
+from typing import List
 
 from dataset import to_device
 from dataset.meshcar_real_sdfgrid_sparse import SparseSDFGridDataset, Collater
@@ -21,6 +25,7 @@ from model.discriminator import Discriminator
 from model.loss import PathLengthPenalty, compute_gradient_penalty
 from model.raycast_rgbd.raycast_rgbd import Raycast2DSparseHandler
 from trainer import create_trainer
+from util.misc import save_jpegs, compute_fid_kid
 from util.timer import Timer
 
 import torch.multiprocessing
@@ -41,7 +46,7 @@ class StyleGAN2Trainer(pl.LightningModule):
         self.train_set = SparseSDFGridDataset(config)
         self.val_set = SparseSDFGridDataset(config, config.num_eval_images)
         self.G = Generator(config.latent_dim, config.latent_dim, config.num_mapping_layers, 64, 3)
-        self.D = Discriminator(config.image_size, 3, w_num_layers=config.num_mapping_layers, mbstd_on=config.mbstd_on, channel_base=config.d_channel_base)
+        self.D = Discriminator(config.image_size, 3, w_num_layers=config.num_mapping_layers, mbstd_on=config.mbstd_on, channel_base=config.d_channel_base).to(memory_format=torch.channels_last)
         self.E = SDFEncoder(1)
         self.R = None
         self.p_synthetic = config.p_synthetic
@@ -53,67 +58,79 @@ class StyleGAN2Trainer(pl.LightningModule):
         self.automatic_optimization = False
         self.path_length_penalty = PathLengthPenalty(0.01, 2)
         self.ema = None
+        self.compiled_D, self.compiled_augment_pipe = None, None
+        self.val_loader, self.grid_loader = None, None
+        # parameter objects survive device moves and checkpoint loading, so the lists are built once
+        self.g_params = list(self.G.parameters())
+        self.g_trainable_params = [p for p in self.g_params if p.requires_grad]
+        self.d_params = list(self.D.parameters())
+        self.z_1, self.z_2, self.z_pl_1, self.z_pl_2 = None, None, None, None
 
     def configure_optimizers(self):
-        g_opt = torch.optim.Adam([
-            {'params': list(self.G.parameters()), 'lr': self.config.lr_g, 'betas': (0.0, 0.99), 'eps': 1e-8},
+        g_opt = MultiTensorAdam([
+            {'params': self.g_params, 'lr': self.config.lr_g, 'betas': (0.0, 0.99), 'eps': 1e-8},
             {'params': list(self.E.parameters()), 'lr': self.config.lr_e, 'eps': 1e-8, 'weight_decay': 1e-4}
         ])
-        d_opt = torch.optim.Adam(self.D.parameters(), lr=self.config.lr_d, betas=(0.0, 0.99), eps=1e-8)
+        d_opt = MultiTensorAdam(self.d_params, lr=self.config.lr_d, betas=(0.0, 0.99), eps=1e-8)
         return g_opt, d_opt
 
-    def forward(self, batch, limit_batch_size=False):
+    def forward(self, batch, limit_batch_size=False, mixed_precision=True):
         z = self.latent(limit_batch_size)
         w = self.get_mapped_latent(z, 0.9)
-        fake = self.G.synthesis(w, batch['sparse_data_064'][0].long(), batch['sparse_data'][0].long(), batch['shape'])
-        return fake, w
+        with self.autocast(mixed_precision):
+            fake = self.G.synthesis(w, batch['sparse_data_064'][0], batch['sparse_data'][0], batch['shape'])
+        # the raycaster only takes fp32 grids
+        return fake.float(), w
+
+    def autocast(self, enabled=True):
+        return torch.cuda.amp.autocast(enabled=enabled and self.config.bf16, dtype=torch.bfloat16)
 
     def g_step(self, batch):
         g_opt = self.optimizers()[0]
         g_opt.zero_grad(set_to_none=True)
         fake, w = self.forward(batch)
-        p_fake = self.D(self.augment_pipe(self.render(fake, batch)))
+        fake_render = self.render(fake, batch)
+        p_fake = self.discriminate(fake_render)
         gen_loss = torch.nn.functional.softplus(-p_fake).mean()
         self.manual_backward(gen_loss)
-        log_gen_loss = gen_loss.item()
-        step(g_opt, self.G)
-        self.log("G", log_gen_loss, on_step=True, on_epoch=False, prog_bar=True, logger=True, sync_dist=True)
+        step(g_opt, self.g_params)
+        self.log("G", gen_loss.detach(), on_step=True, on_epoch=False, prog_bar=True, logger=True)
+        return fake_render.detach()
 
     def g_regularizer(self, batch):
         g_opt = self.optimizers()[0]
-        for idx in range(len(batch['shape'])):
-            batch['shape'][idx] = batch['shape'][idx].detach()
+        batch['shape'] = [code.detach() for code in batch['shape']]
         g_opt.zero_grad(set_to_none=True)
-        fake, w = self.forward(batch)
+        # path length gradients are taken in fp32
+        fake, w = self.forward(batch, mixed_precision=False)
         plp = self.path_length_penalty(self.render(fake, batch), w)
         if not torch.isnan(plp):
             gen_loss = self.config.lambda_plp * plp * self.config.lazy_path_penalty_interval
-            self.log("rPLP", plp, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+            self.log("rPLP", plp, on_step=True, on_epoch=False, prog_bar=False, logger=True)
             self.manual_backward(gen_loss)
-            step(g_opt, self.G)
+            step(g_opt, self.g_params)
 
-    def d_step(self, batch):
+    def d_step(self, batch, fake_render):
         d_opt = self.optimizers()[1]
         d_opt.zero_grad(set_to_none=True)
 
-        fake, _ = self.forward(batch)
-        p_fake = self.D(self.augment_pipe(self.render(fake.detach(), batch)))
+        # reuse the detached render of g_step instead of running G and the raycaster again
+        p_fake = self.discriminate(fake_render)
         fake_loss = torch.nn.functional.softplus(p_fake).mean()
-        self.manual_backward(fake_loss)
 
-        p_real = self.D(self.augment_pipe(self.get_real(batch)))
+        p_real = self.discriminate(self.get_real(batch))
         self.augment_pipe.accumulate_real_sign(p_real.sign().detach())
 
-        # Get discriminator loss
+        # Get discriminator loss, a single backward so gradients are all-reduced once per update
         real_loss = torch.nn.functional.softplus(-p_real).mean()
-        self.manual_backward(real_loss)
+        disc_loss = real_loss + fake_loss
+        self.manual_backward(disc_loss)
 
-        step(d_opt, self.D)
+        step(d_opt, self.d_params)
 
-        self.log("D_real", real_loss, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
-        self.log("D_fake", fake_loss, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
-        disc_loss = real_loss + fake_loss
-        self.log("D", disc_loss, on_step=True, on_epoch=False, prog_bar=True, logger=True, sync_dist=True)
+        self.log("D_real", real_loss.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
+        self.log("D_fake", fake_loss.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
+        self.log("D", disc_loss.detach(), on_step=True, on_epoch=False, prog_bar=True, logger=True)
 
     def d_regularizer(self, batch):
         d_opt = self.optimizers()[1]
@@ -124,15 +141,22 @@ class StyleGAN2Trainer(pl.LightningModule):
         gp = compute_gradient_penalty(image, p_real)
         disc_loss = self.config.lambda_gp * gp * self.config.lazy_gradient_penalty_interval
         self.manual_backward(disc_loss)
-        step(d_opt, self.D)
-        self.log("rGP", gp, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+        step(d_opt, self.d_params)
+        self.log("rGP", gp, on_step=True, on_epoch=False, prog_bar=False, logger=True)
+
+    def discriminate(self, image):
+        with self.autocast():
+            if self.compiled_D is not None:
+                return self.compiled_D(self.compiled_augment_pipe(image)).float()
+            return self.D(self.augment_pipe(image)).float()
 
     def render(self, color_grid, batch, use_bg_color=True):
         r_color = self.R.raycast_sdf(batch['x_dense'], batch['sparse_data'][0], batch['sparse_data'][1],
                                            color_grid.contiguous(), batch['view'], batch['intrinsic'], bg=batch['bg'] if use_bg_color else None)
+        # the NHWC raycast output permuted to NCHW is already a channels_last tensor, which D consumes without a copy
         ret_val = r_color.permute((0, 3, 1, 2))
         if self.config.render_size != self.config.image_size:
-            ret_val = torch.nn.functional.interpolate(ret_val, (self.config.image_size, self.config.image_size), mode='bilinear', align_corners=True)
+            ret_val = torch.nn.functional.interpolate(ret_val, (self.config.image_size, self.config.image_size), mode='bilinear', align_corners=True).contiguous(memory_format=torch.channels_last)
         return ret_val
 
     def get_real(self, batch, use_bg_color=True):
@@ -140,25 +164,25 @@ class StyleGAN2Trainer(pl.LightningModule):
             return self.render(batch['sparse_data'][2], batch)
         else:
             if use_bg_color:
-                return batch['real'] * batch['mask'].expand(-1, 3, -1, -1) + (1 - batch['mask']).expand(-1, 3, -1, -1) * batch['bg'][:, None, None, None]
+                return torch.lerp(batch['bg'][:, None, None, None], batch['real'], batch['mask'])
             else:
                 return batch['real']
 
     def training_step(self, batch, batch_idx):
         self.set_shape_codes(batch)
         # optimize generator
-        self.g_step(batch)
+        fake_render = self.g_step(batch)
 
         # if self.global_step > self.config.lazy_path_penalty_after and (self.global_step + 1) % self.config.lazy_path_penalty_interval == 0:
         #     self.g_regularizer(batch)
 
         # torch.nn.utils.clip_grad_norm_(self.G.parameters(), max_norm=1.0)
 
-        self.ema.update(self.G.parameters())
+        self.ema.update(self.g_params)
 
         # optimize discriminator
 
-        self.d_step(batch)
+        self.d_step(batch, fake_render)
 
         if (self.global_step + 1) % self.config.lazy_gradient_penalty_interval == 0:
             self.d_regularizer(batch)
@@ -168,11 +192,18 @@ class StyleGAN2Trainer(pl.LightningModule):
     def execute_ada_heuristics(self):
         if (self.global_step + 1) % self.config.ada_interval == 0:
             self.augment_pipe.heuristic_update()
-        self.log("aug_p", self.augment_pipe.p.item(), on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+        self.log("aug_p", self.augment_pipe.p, on_step=True, on_epoch=False, prog_bar=False, logger=True)
 
     def validation_step(self, batch, batch_idx):
         pass
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        batch = to_device(batch, device)
+        # reals are converted once per batch so get_real hands D the same layout as the renders
+        for k in ['real', 'mask']:
+            batch[k] = batch[k].contiguous(memory_format=torch.channels_last)
+        return batch
+
     @rank_zero_only
     def validation_epoch_end(self, _val_step_outputs):
         (Path("runs") / self.config.experiment / "checkpoints").mkdir(exist_ok=True)
@@ -180,8 +211,8 @@ class StyleGAN2Trainer(pl.LightningModule):
         with Timer("export_grid"):
             odir_real, odir_fake, odir_samples, odir_grid, odir_meshes = self.create_directories()
             self.export_grid("", odir_grid, None)
-            self.ema.store(self.G.parameters())
-            self.ema.copy_to([p for p in self.G.parameters() if p.requires_grad])
+            self.ema.store(self.g_params)
+            self.ema.copy_to(self.g_trainable_params)
             self.export_grid("ema_", odir_grid, odir_fake)
         with Timer("export_samples"):
             latents = self.grid_z.split(self.config.batch_size)
@@ -189,18 +220,17 @@ class StyleGAN2Trainer(pl.LightningModule):
                 batch = to_device(batch, self.device)
                 self.set_shape_codes(batch)
                 shape = batch['shape']
-                real_render = self.get_real(batch, use_bg_color=False).cpu()
-                fake_render = self.render(self.G(latents[iter_idx % len(latents)].to(self.device), batch['sparse_data_064'][0].long(),
-                                                 batch['sparse_data'][0].long(), shape, noise_mode='const'), batch, use_bg_color=False).cpu()
+                real_render = self.get_real(batch, use_bg_color=False)
+                save_jpegs(real_render, [odir_real / f"{iter_idx}_{batch_idx}.jpg" for batch_idx in range(real_render.shape[0])])
+                real_render = real_render.cpu()
+                fake_render = self.render(self.G(latents[iter_idx % len(latents)], batch['sparse_data_064'][0],
+                                                 batch['sparse_data'][0], shape, noise_mode='const'), batch, use_bg_color=False).cpu()
                 save_image(real_render, odir_samples / f"real_{iter_idx}.jpg", value_range=(-1, 1), normalize=True)
                 save_image(fake_render, odir_samples / f"fake_{iter_idx}.jpg", value_range=(-1, 1), normalize=True)
-                for batch_idx in range(real_render.shape[0]):
-                    save_image(real_render[batch_idx], odir_real / f"{iter_idx}_{batch_idx}.jpg", value_range=(-1, 1), normalize=True)
 
-        self.ema.restore([p for p in self.G.parameters() if p.requires_grad])
-        fid_score = fid.compute_fid(str(odir_real), str(odir_fake), device=self.device, num_workers=0)
+        self.ema.restore(self.g_trainable_params)
+        fid_score, kid_score = compute_fid_kid(odir_real, odir_fake, self.device)
         print(f'FID: {fid_score:.3f}')
-        kid_score = fid.compute_kid(str(odir_real), str(odir_fake), device=self.device, num_workers=0)
         print(f'KID: {kid_score:.3f}')
         self.log(f"fid", fid_score, on_step=False, on_epoch=True, prog_bar=False, logger=True, rank_zero_only=True, sync_dist=True)
         self.log(f"kid", kid_score, on_step=False, on_epoch=True, prog_bar=False, logger=True, rank_zero_only=True, sync_dist=True)
@@ -209,45 +239,55 @@ class StyleGAN2Trainer(pl.LightningModule):
     def get_mapped_latent(self, z, style_mixing_prob):
         if torch.rand(()).item() < style_mixing_prob:
             cross_over_point = int(torch.rand(()).item() * self.G.mapping.num_ws)
-            w1 = self.G.mapping(z[0])[:, :cross_over_point, :]
-            w2 = self.G.mapping(z[1], skip_w_avg_update=True)[:, cross_over_point:, :]
-            return torch.cat((w1, w2), dim=1)
+            # both latents go through the mapping network in one pass, w_avg still only tracks the first
+            w = self.G.mapping(torch.cat(z, dim=0), w_avg_batch_size=z[0].shape[0])
+            w1, w2 = w.chunk(2, dim=0)
+            return torch.cat((w1[:, :cross_over_point, :], w2[:, cross_over_point:, :]), dim=1)
         else:
             w = self.G.mapping(z[0])
             return w
 
     def latent(self, limit_batch_size=False):
-        batch_size = self.config.batch_size if not limit_batch_size else self.config.batch_size // self.path_length_penalty.pl_batch_shrink
-        z1 = torch.randn(batch_size, self.config.latent_dim).to(self.device)
-        z2 = torch.randn(batch_size, self.config.latent_dim).to(self.device)
-        return z1, z2
+        z1, z2 = (self.z_1, self.z_2) if not limit_batch_size else (self.z_pl_1, self.z_pl_2)
+        return z1.normal_(), z2.normal_()
 
     def set_shape_codes(self, batch):
         code = self.E(batch['x_dense_064'])
         batch['shape'] = code
 
     def train_dataloader(self):
-        return DataLoader(self.train_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, num_workers=self.config.num_workers, collate_fn=Collater([], []))
+        return DataLoader(self.train_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, collate_fn=Collater([], []), **self.get_worker_kwargs())
 
     def val_dataloader(self):
-        return DataLoader(self.val_set, self.config.batch_size, shuffle=True, drop_last=True, num_workers=self.config.num_workers, collate_fn=Collater([], []))
+        # shared between lightning's validation loop and validation_epoch_end so its workers stay alive
+        if self.val_loader is None:
+            self.val_loader = DataLoader(self.val_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, collate_fn=Collater([], []), **self.get_worker_kwargs())
+        return self.val_loader
+
+    def get_worker_kwargs(self):
+        if self.config.num_workers == 0:
+            return {'num_workers': 0}
+        return {'num_workers': self.config.num_workers, 'persistent_workers': True}
 
     def export_grid(self, prefix, output_dir_vis, output_dir_fid):
-        vis_generated_images = []
-        grid_loader = iter(DataLoader(self.train_set, batch_size=self.config.batch_size, num_workers=0, drop_last=True, collate_fn=Collater([], [])))
-        for iter_idx, z in enumerate(self.grid_z.split(self.config.batch_size)):
-            z = z.to(self.device)
+        latents = self.grid_z.split(self.config.batch_size)
+        num_vis_batches = min(self.config.num_vis_images // self.config.batch_size, len(latents))
+        vis_generated_images = torch.empty((num_vis_batches * self.config.batch_size, 3, self.config.image_size, self.config.image_size))
+        if self.grid_loader is None:
+            self.grid_loader = DataLoader(self.train_set, batch_size=self.config.batch_size, pin_memory=True, drop_last=True, collate_fn=Collater([], []), **self.get_worker_kwargs())
+        grid_loader = iter(self.grid_loader)
+        for iter_idx, z in enumerate(latents):
+            # without fid outputs only the visualized batches are needed
+            if output_dir_fid is None and iter_idx >= num_vis_batches:
+                break
             eval_batch = to_device(next(grid_loader), self.device)
             self.set_shape_codes(eval_batch)
-            fake_grid = self.G(z, eval_batch['sparse_data_064'][0].long(), eval_batch['sparse_data'][0].long(), eval_batch['shape'], noise_mode='const')
-            fake = self.render(fake_grid, eval_batch, use_bg_color=False).cpu()
+            fake_grid = self.G(z, eval_batch['sparse_data_064'][0], eval_batch['sparse_data'][0], eval_batch['shape'], noise_mode='const')
+            fake = self.render(fake_grid, eval_batch, use_bg_color=False)
             if output_dir_fid is not None:
-                for batch_idx in range(fake.shape[0]):
-                    save_image(fake[batch_idx], output_dir_fid / f"{iter_idx}_{batch_idx}.jpg", value_range=(-1, 1), normalize=True)
-            if iter_idx < self.config.num_vis_images // self.config.batch_size:
-                vis_generated_images.append(fake)
-        torch.cuda.empty_cache()
-        vis_generated_images = torch.cat(vis_generated_images, dim=0)
+                save_jpegs(fake, [output_dir_fid / f"{iter_idx}_{batch_idx}.jpg" for batch_idx in range(fake.shape[0])])
+            if iter_idx < num_vis_batches:
+                vis_generated_images[iter_idx * self.config.batch_size: (iter_idx + 1) * self.config.batch_size] = fake
         save_image(vis_generated_images, output_dir_vis / f"{prefix}{self.global_step:06d}.png", nrow=int(math.sqrt(vis_generated_images.shape[0])), value_range=(-1, 1), normalize=True)
 
     def create_directories(self):
@@ -262,26 +302,38 @@ class StyleGAN2Trainer(pl.LightningModule):
 
     def on_train_start(self):
         if self.ema is None:
-            self.ema = ExponentialMovingAverage(self.G.parameters(), 0.995)
+            self.ema = ExponentialMovingAverage(self.g_params, 0.995)
         if self.R is None:
             self.R = Raycast2DSparseHandler(self.device, self.config.batch_size, (128, 128, 128), (self.config.image_size, self.config.image_size), 0.015625, 0.015625 * 5)
         if self.config.resume_ema is not None:
             self.ema = torch.load(self.config.resume_ema, map_location=self.device)
+        if self.config.compile and self.compiled_D is None:
+            self.compiled_D = torch.compile(self.D.forward)
+            self.compiled_augment_pipe = torch.compile(self.augment_pipe.forward)
+        if self.z_1 is None:
+            pl_batch_size = self.config.batch_size // self.path_length_penalty.pl_batch_shrink
+            self.z_1, self.z_2 = [torch.empty(self.config.batch_size, self.config.latent_dim, device=self.device) for _ in range(2)]
+            self.z_pl_1, self.z_pl_2 = [torch.empty(pl_batch_size, self.config.latent_dim, device=self.device) for _ in range(2)]
 
     def on_validation_start(self):
         if self.ema is None:
-            self.ema = ExponentialMovingAverage(self.G.parameters(), 0.995)
+            self.ema = ExponentialMovingAverage(self.g_params, 0.995)
         if self.R is None:
             self.R = Raycast2DSparseHandler(self.device, self.config.batch_size, (128, 128, 128), (self.config.image_size, self.config.image_size), 0.015625, 0.015625 * 5)
         if self.config.resume_ema is not None:
             self.ema = torch.load(self.config.resume_ema, map_location=self.device)
+        self.grid_z = self.grid_z.to(self.device)
+
+
+@torch.jit.script
+def nan_to_num_(tensors: List[torch.Tensor]):
+    for t in tensors:
+        t.nan_to_num_(nan=0., posinf=1e5, neginf=-1e5)
 
 
-def step(opt, module):
-    for param in module.parameters():
-        if param.grad is not None:
-            torch.nan_to_num(param.grad, nan=0, posinf=1e5, neginf=-1e5, out=param.grad)
-    # torch.nn.utils.clip_grad_norm_(module.parameters(), 1)
+def step(opt, params):
+    nan_to_num_([param.grad for param in params if param.grad is not None])
+    # torch.nn.utils.clip_grad_norm_(params, 1)
     opt.step()
 
 
@@ -1,4 +1,5 @@
 import math
+import random
 import shutil
 from pathlib import Path
 
@@ -7,9 +8,13 @@ import hydra
 import numpy as np
 import pytorch_lightning as pl
 from pytorch_lightning.utilities import rank_zero_only
+try:
+    from torch.optim._multi_tensor import Adam as MultiTensorAdam
+except ImportError:
+    from torch.optim import Adam as MultiTensorAdam
 from torch_ema import ExponentialMovingAverage
 from torchvision.utils import save_image
-from cleanfid import fid
+from typing import List
 
 from dataset.mesh_real_features import FaceGraphMeshDataset
 from dataset import to_vertex_colors_scatter, GraphDataLoader, to_device, to_vertex_shininess_scatter
@@ -20,6 +25,7 @@ from model.graph_generator_u import Generator
 from model.discriminator import Discriminator
 from model.loss import PathLengthPenalty, compute_gradient_penalty
 from trainer import create_trainer
+from util.misc import save_jpegs, compute_fid_kid
 from util.timer import Timer
 
 import torch.multiprocessing
@@ -39,8 +45,10 @@ class StyleGAN2Trainer(pl.LightningModule):
         self.train_set = FaceGraphMeshDataset(config)
         self.val_set = FaceGraphMeshDataset(config, config.num_eval_images)
         self.G = Generator(config.latent_dim, config.latent_dim, config.num_mapping_layers, config.num_faces, 4, channel_base=config.g_channel_base, channel_max=config.g_channel_max)
-        self.D = Discriminator(config.image_size, 3, w_num_layers=config.num_mapping_layers, mbstd_on=config.mbstd_on, channel_base=config.d_channel_base)
+        self.D = Discriminator(config.image_size, 3, w_num_layers=config.num_mapping_layers, mbstd_on=config.mbstd_on, channel_base=config.d_channel_base).to(memory_format=torch.channels_last)
         self.E = GraphEncoder(self.train_set.num_feats)
+        self.g_params = list(self.G.parameters())
+        self.d_params = list(self.D.parameters())
         self.R = None
         self.augment_pipe = AugmentPipe(config.ada_start_p, config.ada_target, config.ada_interval, config.ada_fixed, config.batch_size, config.views_per_sample, config.colorspace)
         # print_module_summary(self.G, (torch.zeros(self.config.batch_size, self.config.latent_dim), ))
@@ -48,75 +56,84 @@ class StyleGAN2Trainer(pl.LightningModule):
         self.grid_z = torch.randn(config.num_eval_images, self.config.latent_dim)
         self.automatic_optimization = False
         self.path_length_penalty = PathLengthPenalty(0.01, 2)
+        self.z_1, self.z_2, self.z_pl_1, self.z_pl_2 = None, None, None, None
         self.ema = None
+        self.compiled_D, self.compiled_augment_pipe = None, None
+        self.val_loader, self.grid_loader, self.mesh_loader = None, None, None
         self.register_parameter('light_mean', torch.nn.Parameter(data=get_light_directions(3).data))
         self.register_parameter('global_shininess', torch.nn.Parameter(data=torch.ones([1]).data * 28))
 
     def configure_optimizers(self):
         param_list = [
-            {'params': list(self.G.parameters()), 'lr': self.config.lr_g, 'betas': (0.0, 0.99), 'eps': 1e-8},
+            {'params': self.g_params, 'lr': self.config.lr_g, 'betas': (0.0, 0.99), 'eps': 1e-8},
             {'params': list(self.E.parameters()), 'lr': self.config.lr_e, 'eps': 1e-8, 'weight_decay': 1e-4}
         ]
         if self.config.optimize_lights:
             param_list.append({'params': self.light_mean, 'lr': self.config.lr_e})
         if self.config.optimize_shininess:
             param_list.append({'params': self.global_shininess, 'lr': self.config.lr_e})
-        g_opt = torch.optim.Adam(param_list)
-        d_opt = torch.optim.Adam(self.D.parameters(), lr=self.config.lr_d, betas=(0.0, 0.99), eps=1e-8)
+        g_opt = MultiTensorAdam(param_list)
+        d_opt = MultiTensorAdam(self.d_params, lr=self.config.lr_d, betas=(0.0, 0.99), eps=1e-8)
         return g_opt, d_opt
 
-    def forward(self, batch, limit_batch_size=False):
+    def forward(self, batch, limit_batch_size=False, use_checkpoint=False, mixed_precision=True):
         z = self.latent(limit_batch_size)
         w = self.get_mapped_latent(z, 0.9)
-        fake = self.G.synthesis(batch['graph_data'], w, batch['shape'])
+        with self.autocast(mixed_precision):
+            fake = self.G.synthesis(batch['graph_data'], w, batch['shape'], use_checkpoint=use_checkpoint)
+        # the renderer only takes fp32 attributes
+        fake = fake.float()
         return fake[:, :3], fake[:, 3:4], w
 
+    def autocast(self, enabled=True):
+        return torch.cuda.amp.autocast(enabled=enabled and self.config.bf16, dtype=torch.bfloat16)
+
     def g_step(self, batch):
         g_opt = self.optimizers()[0]
         g_opt.zero_grad(set_to_none=True)
-        fake_c, fake_ks, w = self.forward(batch)
-        p_fake = self.D(self.augment_pipe(self.render(fake_c, fake_ks, batch)))
+        fake_c, fake_ks, w = self.forward(batch, use_checkpoint=self.config.grad_checkpoint)
+        fake_render = self.render(fake_c, fake_ks, batch)
+        p_fake = self.discriminate(fake_render)
         gen_loss = torch.nn.functional.softplus(-p_fake).mean()
         self.manual_backward(gen_loss)
-        log_gen_loss = gen_loss.item()
-        step(g_opt, self.G)
-        self.log("G", log_gen_loss, on_step=True, on_epoch=False, prog_bar=True, logger=True, sync_dist=True)
+        step(g_opt, self.g_params)
+        self.log("G", gen_loss.detach(), on_step=True, on_epoch=False, prog_bar=True, logger=True)
+        return fake_render.detach()
 
     def g_regularizer(self, batch):
         g_opt = self.optimizers()[0]
-        for idx in range(len(batch['shape'])):
-            batch['shape'][idx] = batch['shape'][idx].detach()
+        # the shape codes of training_step are reused, only their graph to E is cut
+        batch['shape'] = [code.detach() for code in batch['shape']]
         g_opt.zero_grad(set_to_none=True)
-        fake_c, fake_ks, w = self.forward(batch)
+        fake_c, fake_ks, w = self.forward(batch, mixed_precision=False)
         plp = self.path_length_penalty(self.render(fake_c, fake_ks, batch), w)
-        if not torch.isnan(plp):
-            gen_loss = self.config.lambda_plp * plp * self.config.lazy_path_penalty_interval
-            self.log("rPLP", plp, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
-            self.manual_backward(gen_loss)
-            step(g_opt, self.G)
+        if torch.isnan(plp):
+            return
+        gen_loss = self.config.lambda_plp * plp * self.config.lazy_path_penalty_interval
+        self.log("rPLP", plp.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
+        self.manual_backward(gen_loss)
+        step(g_opt, self.g_params)
 
-    def d_step(self, batch):
+    def d_step(self, batch, fake_render):
         d_opt = self.optimizers()[1]
         d_opt.zero_grad(set_to_none=True)
 
-        fake_c, fake_ks, _ = self.forward(batch)
-        p_fake = self.D(self.augment_pipe(self.render(fake_c.detach(), fake_ks.detach(), batch)))
+        p_fake = self.discriminate(fake_render)
         fake_loss = torch.nn.functional.softplus(p_fake).mean()
-        self.manual_backward(fake_loss)
 
-        p_real = self.D(self.augment_pipe(self.train_set.get_color_bg_real(batch)))
+        p_real = self.discriminate(self.train_set.get_color_bg_real(batch))
         self.augment_pipe.accumulate_real_sign(p_real.sign().detach())
 
         # Get discriminator loss
         real_loss = torch.nn.functional.softplus(-p_real).mean()
-        self.manual_backward(real_loss)
+        disc_loss = real_loss + fake_loss
+        self.manual_backward(disc_loss)
 
-        step(d_opt, self.D)
+        step(d_opt, self.d_params)
 
-        self.log("D_real", real_loss, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
-        self.log("D_fake", fake_loss, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
-        disc_loss = real_loss + fake_loss
-        self.log("D", disc_loss, on_step=True, on_epoch=False, prog_bar=True, logger=True, sync_dist=True)
+        self.log("D_real", real_loss.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
+        self.log("D_fake", fake_loss.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
+        self.log("D", disc_loss.detach(), on_step=True, on_epoch=False, prog_bar=True, logger=True)
 
     def d_regularizer(self, batch):
         d_opt = self.optimizers()[1]
@@ -127,25 +144,30 @@ class StyleGAN2Trainer(pl.LightningModule):
         gp = compute_gradient_penalty(image, p_real)
         disc_loss = self.config.lambda_gp * gp * self.config.lazy_gradient_penalty_interval
         self.manual_backward(disc_loss)
-        step(d_opt, self.D)
-        self.log("rGP", gp, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+        step(d_opt, self.d_params)
+        self.log("rGP", gp, on_step=True, on_epoch=False, prog_bar=False, logger=True)
+
+    def discriminate(self, image):
+        with self.autocast():
+            if self.compiled_D is not None:
+                return self.compiled_D(self.compiled_augment_pipe(image)).float()
+            return self.D(self.augment_pipe(image)).float()
 
     def render(self, face_colors, face_shininess, batch, return_combined=True, use_bg_color=True):
         rendered_color, render_shade = self.R.render(batch['vertices'], batch['indices'],
                                                      to_vertex_colors_scatter(face_colors, batch),
                                                      batch['normals'], to_vertex_shininess_scatter(face_shininess, batch),
                                                      sample_light_directions(self.light_mean), batch['view_vector'], self.global_shininess,
-                                                     batch["ranges"].cpu(), batch['bg'] if use_bg_color else None)
+                                                     batch["ranges"], batch['bg'] if use_bg_color else None)
         if return_combined:
-            rendered = rendered_color + render_shade
-            return rendered.permute((0, 3, 1, 2))
+            return combine_shading(rendered_color, render_shade)
         else:
-            return rendered_color.permute((0, 3, 1, 2)), render_shade.permute((0, 3, 1, 2)), (rendered_color + render_shade).permute((0, 3, 1, 2))
+            return rendered_color.permute((0, 3, 1, 2)), render_shade.permute((0, 3, 1, 2)), combine_shading(rendered_color, render_shade)
 
     def training_step(self, batch, batch_idx):
         self.set_shape_codes(batch)
         # optimize generator
-        self.g_step(batch)
+        fake_render = self.g_step(batch)
 
         if self.global_step > self.config.lazy_path_penalty_after and (self.global_step + 1) % self.config.lazy_path_penalty_interval == 0:
             self.g_regularizer(batch)
@@ -156,22 +178,29 @@ class StyleGAN2Trainer(pl.LightningModule):
 
         # optimize discriminator
 
-        self.d_step(batch)
+        self.d_step(batch, fake_render)
 
         if (self.global_step + 1) % self.config.lazy_gradient_penalty_interval == 0:
             self.d_regularizer(batch)
 
         self.execute_ada_heuristics()
-        self.log("shininess", self.global_shininess.item(), on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+        self.log("shininess", self.global_shininess.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
 
     def execute_ada_heuristics(self):
         if (self.global_step + 1) % self.config.ada_interval == 0:
             self.augment_pipe.heuristic_update()
-        self.log("aug_p", self.augment_pipe.p.item(), on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+        self.log("aug_p", self.augment_pipe.p, on_step=True, on_epoch=False, prog_bar=False, logger=True)
 
     def validation_step(self, batch, batch_idx):
         pass
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        # ranges are only read on the host by the rasterizer, to_device leaves them there
+        batch = to_device(batch, device)
+        for k in ['real', 'mask']:
+            batch[k] = batch[k].contiguous(memory_format=torch.channels_last)
+        return batch
+
     @rank_zero_only
     def validation_epoch_end(self, _val_step_outputs):
         (Path("runs") / self.config.experiment / "checkpoints").mkdir(exist_ok=True)
@@ -189,58 +218,60 @@ class StyleGAN2Trainer(pl.LightningModule):
                 batch = to_device(batch, self.device)
                 self.set_shape_codes(batch)
                 shape = batch['shape']
-                real_render = batch['real'].cpu()
-                fake = self.G(batch['graph_data'], latents[iter_idx % len(latents)].to(self.device), shape, noise_mode='const')
+                fake = self.G(batch['graph_data'], latents[iter_idx % len(latents)], shape, noise_mode='const')
                 fake_c, fake_ks = fake[:, :3], fake[:, 3:4]
                 fake_render_c, fake_render_ks, fake_render = self.render(fake_c, fake_ks, batch, return_combined=False, use_bg_color=False)
-                real_render = self.train_set.cspace_convert_back(real_render)
-                fake_render_c = self.train_set.cspace_convert_back(fake_render_c).cpu()
-                fake_render = self.train_set.cspace_convert_back(fake_render).cpu()
+                # one colorspace conversion for the reals and both fake renders
+                real_render, fake_render_c, fake_render = self.train_set.cspace_convert_back(torch.cat([batch['real'], fake_render_c, fake_render]).cpu()).chunk(3)
                 save_image(real_render, odir_samples / f"real_{iter_idx}.jpg", value_range=(-1, 1), normalize=True)
                 save_image(torch.cat([fake_render, fake_render_ks.cpu().expand(-1, 3, -1, -1), fake_render_c]), odir_samples / f"fake_{iter_idx}.jpg",
                            nrow=self.config.batch_size, value_range=(-1, 1), normalize=True)
-                for batch_idx in range(real_render.shape[0]):
-                    save_image(real_render[batch_idx], odir_real / f"{iter_idx}_{batch_idx}.jpg", value_range=(-1, 1), normalize=True)
+                save_jpegs(real_render, [odir_real / f"{iter_idx}_{batch_idx}.jpg" for batch_idx in range(real_render.shape[0])])
         self.ema.restore([p for p in self.G.parameters() if p.requires_grad])
-        fid_score = fid.compute_fid(str(odir_real), str(odir_fake), device=self.device, num_workers=0)
+        fid_score, kid_score = compute_fid_kid(odir_real, odir_fake, self.device)
         print(f'FID: {fid_score:.3f}')
-        kid_score = fid.compute_kid(str(odir_real), str(odir_fake), device=self.device, num_workers=0)
         print(f'KID: {kid_score:.3f}')
         self.log(f"fid", fid_score, on_step=False, on_epoch=True, prog_bar=False, logger=True, rank_zero_only=True, sync_dist=True)
         self.log(f"kid", kid_score, on_step=False, on_epoch=True, prog_bar=False, logger=True, rank_zero_only=True, sync_dist=True)
         shutil.rmtree(odir_real.parent)
 
     def get_mapped_latent(self, z, style_mixing_prob):
-        if torch.rand(()).item() < style_mixing_prob:
-            cross_over_point = int(torch.rand(()).item() * self.G.mapping.num_ws)
-            w1 = self.G.mapping(z[0])[:, :cross_over_point, :]
-            w2 = self.G.mapping(z[1], skip_w_avg_update=True)[:, cross_over_point:, :]
-            return torch.cat((w1, w2), dim=1)
+        if random.random() < style_mixing_prob:
+            cross_over_point = int(random.random() * self.G.mapping.num_ws)
+            w = self.G.mapping(torch.cat(z, dim=0), w_avg_batch_size=z[0].shape[0])
+            w1, w2 = w.chunk(2, dim=0)
+            return torch.cat((w1[:, :cross_over_point, :], w2[:, cross_over_point:, :]), dim=1)
         else:
             w = self.G.mapping(z[0])
             return w
 
     def latent(self, limit_batch_size=False):
-        batch_size = self.config.batch_size if not limit_batch_size else self.config.batch_size // self.path_length_penalty.pl_batch_shrink
-        z1 = torch.randn(batch_size, self.config.latent_dim).to(self.device)
-        z2 = torch.randn(batch_size, self.config.latent_dim).to(self.device)
-        return z1, z2
+        z1, z2 = (self.z_1, self.z_2) if not limit_batch_size else (self.z_pl_1, self.z_pl_2)
+        return z1.normal_(), z2.normal_()
 
     def set_shape_codes(self, batch):
         code = self.E(batch['x'], batch['graph_data'])
         batch['shape'] = code
 
     def train_dataloader(self):
-        return GraphDataLoader(self.train_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, num_workers=self.config.num_workers)
+        return GraphDataLoader(self.train_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, **self.get_worker_kwargs())
 
     def val_dataloader(self):
-        return GraphDataLoader(self.val_set, self.config.batch_size, shuffle=True, drop_last=True, num_workers=self.config.num_workers)
+        if self.val_loader is None:
+            self.val_loader = GraphDataLoader(self.val_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, **self.get_worker_kwargs())
+        return self.val_loader
+
+    def get_worker_kwargs(self):
+        if self.config.num_workers == 0:
+            return {'num_workers': 0}
+        return {'num_workers': self.config.num_workers, 'persistent_workers': True}
 
     def export_grid(self, prefix, output_dir_vis, output_dir_fid):
         vis_generated_images = []
-        grid_loader = iter(GraphDataLoader(self.train_set, batch_size=self.config.batch_size))
+        if self.grid_loader is None:
+            self.grid_loader = GraphDataLoader(self.train_set, batch_size=self.config.batch_size, pin_memory=True, **self.get_worker_kwargs())
+        grid_loader = iter(self.grid_loader)
         for iter_idx, z in enumerate(self.grid_z.split(self.config.batch_size)):
-            z = z.to(self.device)
             eval_batch = to_device(next(grid_loader), self.device)
             self.set_shape_codes(eval_batch)
             fake = self.G(eval_batch['graph_data'], z, eval_batch['shape'], noise_mode='const')
@@ -248,8 +279,7 @@ class StyleGAN2Trainer(pl.LightningModule):
             fake = self.render(fake_c, fake_ks, eval_batch, use_bg_color=False).cpu()
             fake = self.train_set.cspace_convert_back(fake)
             if output_dir_fid is not None:
-                for batch_idx in range(fake.shape[0]):
-                    save_image(fake[batch_idx], output_dir_fid / f"{iter_idx}_{batch_idx}.jpg", value_range=(-1, 1), normalize=True)
+                save_jpegs(fake, [output_dir_fid / f"{iter_idx}_{batch_idx}.jpg" for batch_idx in range(fake.shape[0])])
             if iter_idx < self.config.num_vis_images // self.config.batch_size:
                 vis_generated_images.append(fake)
         torch.cuda.empty_cache()
@@ -257,10 +287,11 @@ class StyleGAN2Trainer(pl.LightningModule):
         save_image(vis_generated_images, output_dir_vis / f"{prefix}{self.global_step:06d}.png", nrow=int(math.sqrt(vis_generated_images.shape[0])), value_range=(-1, 1), normalize=True)
 
     def export_mesh(self, outdir):
-        grid_loader = iter(GraphDataLoader(self.train_set, batch_size=self.config.batch_size, shuffle=True))
+        if self.mesh_loader is None:
+            self.mesh_loader = GraphDataLoader(self.train_set, batch_size=self.config.batch_size, shuffle=True, pin_memory=True, **self.get_worker_kwargs())
+        grid_loader = iter(self.mesh_loader)
         for iter_idx, z in enumerate(self.grid_z.split(self.config.batch_size)):
             if iter_idx < self.config.num_vis_meshes // self.config.batch_size:
-                z = z.to(self.device)
                 eval_batch = to_device(next(grid_loader), self.device)
                 self.set_shape_codes(eval_batch)
                 generated_colors = torch.clamp(self.G(eval_batch['graph_data'], z, eval_batch['shape'], noise_mode='const')[:, :3], -1, 1)
@@ -285,44 +316,60 @@ class StyleGAN2Trainer(pl.LightningModule):
             self.ema = ExponentialMovingAverage(self.G.parameters(), 0.995)
         if self.R is None:
             self.R = DifferentiableRenderer(self.config.image_size, "bounds", self.config.colorspace)
+        if self.config.grad_checkpoint and (self.trainer.world_size > 1 or self.config.bf16):
+            # the reentrant checkpoint breaks ddp's unused parameter search and replays the blocks under fp16 instead of bf16 autocast
+            raise ValueError("grad_checkpoint is only supported for single-device fp32 training")
+        if self.config.compile and self.compiled_D is None:
+            self.compiled_D = torch.compile(self.D.forward)
+            self.compiled_augment_pipe = torch.compile(self.augment_pipe.forward)
+        if self.z_1 is None:
+            pl_batch_size = self.config.batch_size // self.path_length_penalty.pl_batch_shrink
+            self.z_1, self.z_2 = [torch.empty(self.config.batch_size, self.config.latent_dim, device=self.device) for _ in range(2)]
+            self.z_pl_1, self.z_pl_2 = [torch.empty(pl_batch_size, self.config.latent_dim, device=self.device) for _ in range(2)]
 
     def on_validation_start(self):
         if self.ema is None:
             self.ema = ExponentialMovingAverage(self.G.parameters(), 0.995)
         if self.R is None:
             self.R = DifferentiableRenderer(self.config.image_size, "bounds", self.config.colorspace)
+        self.grid_z = self.grid_z.to(self.device)
+
 
+@torch.jit.script
+def nan_to_num_(tensors: List[torch.Tensor]):
+    for t in tensors:
+        t.nan_to_num_(nan=0., posinf=1e5, neginf=-1e5)
 
-def step(opt, module):
-    for param in module.parameters():
-        if param.grad is not None:
-            torch.nan_to_num(param.grad, nan=0, posinf=1e5, neginf=-1e5, out=param.grad)
-    torch.nn.utils.clip_grad_norm_(module.parameters(), 1)
+
+def step(opt, params):
+    nan_to_num_([param.grad for param in params if param.grad is not None])
+    torch.nn.utils.clip_grad_norm_(params, 1)
     opt.step()
 
 
 def get_light_directions(num_lights, device=torch.device("cpu")):
     angles = torch.linspace(0, 2, steps=num_lights + 1, device=device)[:num_lights]
     phi = np.pi * angles
-    theta = np.pi * torch.tensor([1.0 / 2.0] * num_lights, device=device)
-    light_dirs = []
-    for i in range(angles.shape[0]):
-        xp = torch.sin(theta[i]) * torch.cos(phi[i])
-        zp = torch.sin(theta[i]) * torch.sin(phi[i])
-        yp = torch.cos(theta[i])
-        z = torch.tensor([xp, yp, zp], device=device)
-        z = z / (torch.linalg.norm(z) + 1e-8)
-        light_dirs.append(-z)
-    return torch.stack(light_dirs, dim=0)
+    theta = np.pi * torch.full([num_lights], 1.0 / 2.0, device=device)
+    z = torch.stack([torch.sin(theta) * torch.cos(phi), torch.cos(theta), torch.sin(theta) * torch.sin(phi)], dim=1)
+    z = z / (torch.linalg.norm(z, dim=1, keepdim=True) + 1e-8)
+    return -z
 
 
+@torch.jit.script
 def sample_light_directions(mean_light_directions):
     var = 0.05
-    light_directions = mean_light_directions + torch.randn([mean_light_directions.shape[0], 3], device=mean_light_directions.device) * var
+    light_directions = mean_light_directions + torch.randn_like(mean_light_directions) * var
     light_directions = torch.nn.functional.normalize(light_directions, p=2.0, dim=1)
     return light_directions
 
 
+@torch.jit.script
+def combine_shading(rendered_color, render_shade):
+    # the NHWC sum permuted to NCHW is already a channels_last tensor, which D consumes without a copy
+    return (rendered_color + render_shade).permute((0, 3, 1, 2))
+
+
 @hydra.main(config_path='../config', config_name='stylegan2')
 def main(config):
     trainer = create_trainer("StyleGAN23D", config)
@@ -7,9 +7,13 @@ import torch
 import hydra
 import pytorch_lightning as pl
 from pytorch_lightning.utilities import rank_zero_only
+try:
+    from torch.optim._multi_tensor import Adam as MultiTensorAdam
+except ImportError:
+    from torch.optim import Adam as MultiTensorAdam
 from torch_ema import ExponentialMovingAverage
 from torchvision.utils import save_image
-from cleanfid import fid
+from typing import List
 
 from dataset.mesh_real_features_patch import FaceGraphMeshDataset
 from dataset import to_vertex_colors_scatter, GraphDataLoader, to_device
@@ -18,8 +22,9 @@ from model.differentiable_renderer import DifferentiableRenderer
 from model.graph import GraphEncoder
 from model.graph_generator_u import Generator
 from model.discriminator import Discriminator
-from model.loss import PathLengthPenalty, compute_gradient_penalty
+from model.loss import PathLengthPenalty, compute_gradient_penalty, softplus_mean
 from trainer import create_trainer
+from util.misc import save_jpegs, compute_fid_kid
 from util.timer import Timer
 
 import torch.multiprocessing
@@ -39,9 +44,13 @@ class StyleGAN2Trainer(pl.LightningModule):
         self.train_set = FaceGraphMeshDataset(config)
         self.val_set = FaceGraphMeshDataset(config, config.num_eval_images)
         self.G = Generator(config.latent_dim, config.latent_dim, config.num_mapping_layers, config.num_faces, 3, channel_base=config.g_channel_base, channel_max=config.g_channel_max)
-        self.D = Discriminator(config.image_size, 3, w_num_layers=config.num_mapping_layers, mbstd_on=config.mbstd_on, channel_base=config.d_channel_base)
-        self.patch_D = Discriminator(config.patch_size, 3 * config.views_per_sample * config.num_patch_per_view, w_num_layers=config.num_mapping_layers, mbstd_on=config.mbstd_on, channel_base=config.d_channel_base)
+        self.D = Discriminator(config.image_size, 3, w_num_layers=config.num_mapping_layers, mbstd_on=config.mbstd_on, channel_base=config.d_channel_base).to(memory_format=torch.channels_last)
+        self.patch_D = Discriminator(config.patch_size, 3 * config.views_per_sample * config.num_patch_per_view, w_num_layers=config.num_mapping_layers, mbstd_on=config.mbstd_on, channel_base=config.d_channel_base).to(memory_format=torch.channels_last)
         self.E = GraphEncoder(self.train_set.num_feats)
+        self.g_params = list(self.G.parameters())
+        self.g_trainable_params = [p for p in self.g_params if p.requires_grad]
+        self.d_params = list(self.D.parameters())
+        self.patch_d_params = list(self.patch_D.parameters())
         self.R = None
         self.augment_pipe = AugmentPipe(config.ada_start_p, config.ada_target, config.ada_interval, config.ada_fixed, config.batch_size, config.views_per_sample, config.colorspace)
         # print_module_summary(self.G, (torch.zeros(self.config.batch_size, self.config.latent_dim), ))
@@ -51,21 +60,28 @@ class StyleGAN2Trainer(pl.LightningModule):
         self.automatic_optimization = False
         self.path_length_penalty = PathLengthPenalty(0.01, 2)
         self.ema = None
+        self.compiled_D, self.compiled_augment_pipe, self.compiled_patch_D = None, None, None
+        self.val_loader, self.grid_loader, self.mesh_loader = None, None, None
+        self.fid_dirs_cleared = False
 
     def configure_optimizers(self):
-        g_opt = torch.optim.Adam([
-            {'params': list(self.G.parameters()), 'lr': self.config.lr_g, 'betas': (0.0, 0.99), 'eps': 1e-8},
+        g_opt = MultiTensorAdam([
+            {'params': self.g_params, 'lr': self.config.lr_g, 'betas': (0.0, 0.99), 'eps': 1e-8},
             {'params': list(self.E.parameters()), 'lr': self.config.lr_e, 'eps': 1e-8, 'weight_decay': 1e-4}
         ])
-        d_opt = torch.optim.Adam(self.D.parameters(), lr=self.config.lr_d, betas=(0.0, 0.99), eps=1e-8)
-        patch_d_opt = torch.optim.Adam(self.patch_D.parameters(), lr=self.config.lr_d, betas=(0.0, 0.99), eps=1e-8)
+        d_opt = MultiTensorAdam(self.d_params, lr=self.config.lr_d, betas=(0.0, 0.99), eps=1e-8)
+        patch_d_opt = MultiTensorAdam(self.patch_d_params, lr=self.config.lr_d, betas=(0.0, 0.99), eps=1e-8)
         return g_opt, d_opt, patch_d_opt
 
-    def forward(self, batch, limit_batch_size=False):
+    def forward(self, batch, limit_batch_size=False, mixed_precision=True):
         z = self.latent(limit_batch_size)
         w = self.get_mapped_latent(z, 0.9)
-        fake = self.G.synthesis(batch['graph_data'], w, batch['shape'])
-        return fake, w
+        with self.autocast(mixed_precision):
+            fake = self.G.synthesis(batch['graph_data'], w, batch['shape'])
+        return fake.float(), w
+
+    def autocast(self, enabled=True):
+        return torch.cuda.amp.autocast(enabled=enabled and self.config.bf16, dtype=torch.bfloat16)
 
     def g_step(self, batch):
         g_opt = self.optimizers()[0]
@@ -74,141 +90,156 @@ class StyleGAN2Trainer(pl.LightningModule):
 
         fake_render = self.render(fake, batch)
 
-        d_input = torch.nn.functional.interpolate(fake_render[:, :3, :, :], size=(self.config.image_size, self.config.image_size), mode='bilinear', align_corners=False)
-        p_fake = self.D(self.augment_pipe(d_input))
-        gen_loss = torch.nn.functional.softplus(-p_fake).mean()
+        d_input = self.resize_render(fake_render)
+        p_fake = self.discriminate(d_input)
+        gen_loss = softplus_mean(p_fake, -1.)
 
-        d_patch_input = self.extract_patches_from_tensor(fake_render[:, :3, :, :], 1 - fake_render[:, 3, :, :], self.config.num_patch_per_view, self.config.patch_size)
-        d_patch_input = d_patch_input.reshape(batch['real'].shape[0] // self.config.views_per_sample, -1, self.config.patch_size, self.config.patch_size)
-        p_fake_patch = self.patch_D(d_patch_input)
-        gen_loss_patch = torch.nn.functional.softplus(-p_fake_patch).mean()
+        d_patch_input = self.extract_patches_from_tensor(fake_render[:, :3, :, :], 1 - fake_render[:, 3, :, :], self.config.num_patch_per_view, self.config.patch_size,
+                                                         batch['real'].shape[0] // self.config.views_per_sample)
+        p_fake_patch = self.discriminate_patch(d_patch_input)
+        gen_loss_patch = softplus_mean(p_fake_patch, -1.)
 
         self.manual_backward(gen_loss + self.config.lambda_patch * gen_loss_patch)
-        log_gen_loss = gen_loss.item()
-        log_gen_loss_patch = gen_loss_patch.item()
 
-        step(g_opt, self.G)
-        self.log("G", log_gen_loss, on_step=True, on_epoch=False, prog_bar=True, logger=True, sync_dist=True)
-        self.log("G_patch", log_gen_loss_patch, on_step=True, on_epoch=False, prog_bar=True, logger=True, sync_dist=True)
+        step(g_opt, self.g_params)
+        self.log("G", gen_loss.detach(), on_step=True, on_epoch=False, prog_bar=True, logger=True)
+        self.log("G_patch", gen_loss_patch.detach(), on_step=True, on_epoch=False, prog_bar=True, logger=True)
+        return fake_render.detach()
 
     def g_regularizer(self, batch):
         g_opt = self.optimizers()[0]
-        for idx in range(len(batch['shape'])):
-            batch['shape'][idx] = batch['shape'][idx].detach()
+        batch['shape'] = [code.detach() for code in batch['shape']]
         g_opt.zero_grad(set_to_none=True)
-        fake, w = self.forward(batch)
+        fake, w = self.forward(batch, mixed_precision=False)
         fake_render = self.render(fake, batch)
-        resized_fake_render = torch.nn.functional.interpolate(fake_render[:, :3, :, :], size=(self.config.image_size, self.config.image_size), mode='bilinear', align_corners=False)
+        resized_fake_render = self.resize_render(fake_render)
         plp = self.path_length_penalty(resized_fake_render, w)
-        if not torch.isnan(plp):
-            gen_loss = self.config.lambda_plp * plp * self.config.lazy_path_penalty_interval
-            self.log("rPLP", plp, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
-            self.manual_backward(gen_loss)
-            step(g_opt, self.G)
-
-    def d_step(self, batch):
+        if torch.isnan(plp):
+            return
+        gen_loss = self.config.lambda_plp * plp * self.config.lazy_path_penalty_interval
+        self.log("rPLP", plp.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
+        self.manual_backward(gen_loss)
+        step(g_opt, self.g_params)
+
+    def d_step(self, batch, fake_render):
         d_opt = self.optimizers()[1]
         d_opt.zero_grad(set_to_none=True)
 
-        fake, _ = self.forward(batch)
-        fake_render = self.render(fake.detach(), batch)
-        d_input = torch.nn.functional.interpolate(fake_render[:, :3, :, :], size=(self.config.image_size, self.config.image_size), mode='bilinear', align_corners=False)
-        p_fake = self.D(self.augment_pipe(d_input))
-        fake_loss = torch.nn.functional.softplus(p_fake).mean()
+        # both discriminators reuse the detached render of g_step instead of running G and the renderer again
+        d_input = self.resize_render(fake_render)
+        p_fake = self.discriminate(d_input)
+        fake_loss = softplus_mean(p_fake, 1.)
         self.manual_backward(fake_loss)
 
-        p_real = self.D(self.augment_pipe(self.train_set.get_color_bg_real(batch)))
+        p_real = self.discriminate(batch['real_bg'])
         self.augment_pipe.accumulate_real_sign(p_real.sign().detach())
 
         # Get discriminator loss
-        real_loss = torch.nn.functional.softplus(-p_real).mean()
+        real_loss = softplus_mean(p_real, -1.)
         self.manual_backward(real_loss)
 
-        step(d_opt, self.D)
+        step(d_opt, self.d_params)
 
-        self.log("D_real", real_loss, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
-        self.log("D_fake", fake_loss, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+        self.log("D_real", real_loss.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
+        self.log("D_fake", fake_loss.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
         disc_loss = real_loss + fake_loss
-        self.log("D", disc_loss, on_step=True, on_epoch=False, prog_bar=True, logger=True, sync_dist=True)
+        self.log("D", disc_loss.detach(), on_step=True, on_epoch=False, prog_bar=True, logger=True)
 
-    def patch_d_step(self, batch):
+    def patch_d_step(self, batch, fake_render):
         d_opt = self.optimizers()[2]
         d_opt.zero_grad(set_to_none=True)
 
-        fake, _ = self.forward(batch)
-        fake_render = self.render(fake.detach(), batch)
-        d_patch_input = self.extract_patches_from_tensor(fake_render[:, :3, :, :], 1 - fake_render[:, 3, :, :], self.config.num_patch_per_view, self.config.patch_size)
-        d_patch_input = d_patch_input.reshape(batch['real'].shape[0] // self.config.views_per_sample, -1, self.config.patch_size, self.config.patch_size)
+        d_patch_input = self.extract_patches_from_tensor(fake_render[:, :3, :, :], 1 - fake_render[:, 3, :, :], self.config.num_patch_per_view, self.config.patch_size,
+                                                         batch['real'].shape[0] // self.config.views_per_sample)
 
-        p_fake = self.patch_D(d_patch_input)
-        fake_loss = torch.nn.functional.softplus(p_fake).mean()
+        p_fake = self.discriminate_patch(d_patch_input)
+        fake_loss = softplus_mean(p_fake, 1.)
         self.manual_backward(fake_loss)
 
-        real = self.train_set.get_color_bg_real_hres(batch)
+        real = batch['real_bg_hres']
         first_views = list(range(0, real.shape[0], self.config.views_per_sample))
-        real_patch = self.extract_patches_from_tensor(real[first_views], batch['mask_hres'][first_views, 0, :, :], self.config.num_patch_per_view * self.config.views_per_sample, self.config.patch_size)
-        real_patch = real_patch.reshape(real.shape[0] // self.config.views_per_sample, -1, self.config.patch_size, self.config.patch_size)
+        real_patch = self.extract_patches_from_tensor(real[first_views], batch['mask_hres'][first_views, 0, :, :], self.config.num_patch_per_view * self.config.views_per_sample, self.config.patch_size,
+                                                      real.shape[0] // self.config.views_per_sample)
 
-        p_real = self.patch_D(real_patch)
+        p_real = self.discriminate_patch(real_patch)
 
         # Get discriminator loss
-        real_loss = torch.nn.functional.softplus(-p_real).mean()
+        real_loss = softplus_mean(p_real, -1.)
         self.manual_backward(real_loss)
 
-        step(d_opt, self.patch_D)
+        step(d_opt, self.patch_d_params)
 
-        self.log("patch_D_real", real_loss, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
-        self.log("patch_D_fake", fake_loss, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+        self.log("patch_D_real", real_loss.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
+        self.log("patch_D_fake", fake_loss.detach(), on_step=True, on_epoch=False, prog_bar=False, logger=True)
         disc_loss = real_loss + fake_loss
-        self.log("patch_D", disc_loss, on_step=True, on_epoch=False, prog_bar=True, logger=True, sync_dist=True)
+        self.log("patch_D", disc_loss.detach(), on_step=True, on_epoch=False, prog_bar=True, logger=True)
 
     def d_regularizer(self, batch):
         d_opt = self.optimizers()[1]
         d_opt.zero_grad(set_to_none=True)
-        image = self.train_set.get_color_bg_real(batch)
-        image.requires_grad_()
+        image = batch['real_bg'].detach().requires_grad_()
         p_real = self.D(self.augment_pipe(image, True))
         gp = compute_gradient_penalty(image, p_real)
         disc_loss = self.config.lambda_gp * gp * self.config.lazy_gradient_penalty_interval
         self.manual_backward(disc_loss)
-        step(d_opt, self.D)
-        self.log("rGP", gp, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+        step(d_opt, self.d_params)
+        self.log("rGP", gp, on_step=True, on_epoch=False, prog_bar=False, logger=True)
 
     def patch_d_regularizer(self, batch):
         d_opt = self.optimizers()[2]
         d_opt.zero_grad(set_to_none=True)
-        image = self.train_set.get_color_bg_real_hres(batch)
-        image.requires_grad_()
+        image = batch['real_bg_hres'].detach().requires_grad_()
         first_views = list(range(0, image.shape[0], self.config.views_per_sample))
-        patch = self.extract_patches_from_tensor(image[first_views], batch['mask_hres'][first_views, 0, :, :], self.config.num_patch_per_view * self.config.views_per_sample, self.config.patch_size)
-        real_patch = patch.reshape(image.shape[0] // self.config.views_per_sample, -1, self.config.patch_size, self.config.patch_size)
+        real_patch = self.extract_patches_from_tensor(image[first_views], batch['mask_hres'][first_views, 0, :, :], self.config.num_patch_per_view * self.config.views_per_sample, self.config.patch_size,
+                                                      image.shape[0] // self.config.views_per_sample)
         p_real = self.patch_D(real_patch)
         gp = compute_gradient_penalty(image, p_real)
         disc_loss = self.config.lambda_gp * gp * self.config.lazy_gradient_penalty_interval
         self.manual_backward(disc_loss)
-        step(d_opt, self.patch_D)
-        self.log("patch_rGP", gp, on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+        step(d_opt, self.patch_d_params)
+        self.log("patch_rGP", gp, on_step=True, on_epoch=False, prog_bar=False, logger=True)
+
+    def discriminate(self, image):
+        with self.autocast():
+            if self.compiled_D is not None:
+                return self.compiled_D(self.compiled_augment_pipe(image)).float()
+            return self.D(self.augment_pipe(image)).float()
+
+    def discriminate_patch(self, patches):
+        with self.autocast():
+            if self.compiled_patch_D is not None:
+                return self.compiled_patch_D(patches).float()
+            return self.patch_D(patches).float()
+
+    def resize_render(self, render):
+        # D only sees the colour channels at image_size, the mask channel is only read for patch extraction
+        if render.shape[-2:] == (self.config.image_size, self.config.image_size):
+            return render[:, :3, :, :]
+        return torch.nn.functional.interpolate(render[:, :3, :, :], size=(self.config.image_size, self.config.image_size), mode='bilinear', align_corners=False).contiguous(memory_format=torch.channels_last)
 
     def render(self, face_colors, batch, use_bg_color=True):
-        rendered_color = self.R.render(batch['vertices'], batch['indices'], to_vertex_colors_scatter(face_colors, batch), batch["ranges"].cpu(), batch['bg'] if use_bg_color else None)
+        rendered_color = self.R.render(batch['vertices'], batch['indices'], to_vertex_colors_scatter(face_colors, batch), batch["ranges"], batch['bg'] if use_bg_color else None)
         return rendered_color.permute((0, 3, 1, 2))
 
     def training_step(self, batch, batch_idx):
         self.set_shape_codes(batch)
+        # the composited reals are shared by both discriminator steps and their regularizers
+        batch['real_bg'] = self.train_set.get_color_bg_real(batch)
+        batch['real_bg_hres'] = self.train_set.get_color_bg_real_hres(batch)
         # optimize generator
-        self.g_step(batch)
+        fake_render = self.g_step(batch)
 
         if self.global_step > self.config.lazy_path_penalty_after and (self.global_step + 1) % self.config.lazy_path_penalty_interval == 0:
             self.g_regularizer(batch)
 
         # torch.nn.utils.clip_grad_norm_(self.G.parameters(), max_norm=1.0)
 
-        self.ema.update(self.G.parameters())
+        self.ema.update(self.g_params)
 
         # optimize discriminator
 
-        self.d_step(batch)
-        self.patch_d_step(batch)
+        self.d_step(batch, fake_render)
+        self.patch_d_step(batch, fake_render)
 
         if (self.global_step + 1) % self.config.lazy_gradient_penalty_interval == 0:
             self.d_regularizer(batch)
@@ -219,11 +250,17 @@ class StyleGAN2Trainer(pl.LightningModule):
     def execute_ada_heuristics(self):
         if (self.global_step + 1) % self.config.ada_interval == 0:
             self.augment_pipe.heuristic_update()
-        self.log("aug_p", self.augment_pipe.p.item(), on_step=True, on_epoch=False, prog_bar=False, logger=True, sync_dist=True)
+        self.log("aug_p", self.augment_pipe.p, on_step=True, on_epoch=False, prog_bar=False, logger=True)
 
     def validation_step(self, batch, batch_idx):
         pass
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        batch = to_device(batch, device)
+        for k in ['real', 'mask', 'real_hres', 'mask_hres']:
+            batch[k] = batch[k].contiguous(memory_format=torch.channels_last)
+        return batch
+
     @rank_zero_only
     def validation_epoch_end(self, _val_step_outputs):
         (Path("runs") / self.config.experiment / "checkpoints").mkdir(exist_ok=True)
@@ -231,8 +268,8 @@ class StyleGAN2Trainer(pl.LightningModule):
         with Timer("export_grid"):
             odir_real, odir_fake, odir_samples, odir_grid, odir_meshes = self.create_directories()
             self.export_grid("", odir_grid, None)
-            self.ema.store(self.G.parameters())
-            self.ema.copy_to([p for p in self.G.parameters() if p.requires_grad])
+            self.ema.store(self.g_params)
+            self.ema.copy_to(self.g_trainable_params)
             self.export_grid("ema_", odir_grid, odir_fake)
             self.export_mesh(odir_meshes)
         with Timer("export_samples"):
@@ -243,28 +280,25 @@ class StyleGAN2Trainer(pl.LightningModule):
                 shape = batch['shape']
                 real_render = batch['real'].cpu()
                 fake_render = self.render(self.G(batch['graph_data'], latents[iter_idx % len(latents)].to(self.device), shape, noise_mode='const'), batch, use_bg_color=False)
-                fake_render = torch.nn.functional.interpolate(fake_render[:, :3, :, :], size=(self.config.image_size, self.config.image_size), mode='bilinear', align_corners=False).cpu()
+                fake_render = self.resize_render(fake_render).cpu()
                 real_render = self.train_set.cspace_convert_back(real_render)
                 fake_render = self.train_set.cspace_convert_back(fake_render)
                 save_image(real_render, odir_samples / f"real_{iter_idx}.jpg", value_range=(-1, 1), normalize=True)
                 save_image(fake_render, odir_samples / f"fake_{iter_idx}.jpg", value_range=(-1, 1), normalize=True)
-                for batch_idx in range(real_render.shape[0]):
-                    save_image(real_render[batch_idx], odir_real / f"{iter_idx}_{batch_idx}.jpg", value_range=(-1, 1), normalize=True)
-        self.ema.restore([p for p in self.G.parameters() if p.requires_grad])
-        fid_score = fid.compute_fid(str(odir_real), str(odir_fake), device=self.device, num_workers=0)
+                save_jpegs(real_render, [odir_real / f"{iter_idx}_{batch_idx}.jpg" for batch_idx in range(real_render.shape[0])])
+        self.ema.restore(self.g_trainable_params)
+        fid_score, kid_score = compute_fid_kid(odir_real, odir_fake, self.device)
         print(f'FID: {fid_score:.3f}')
-        kid_score = fid.compute_kid(str(odir_real), str(odir_fake), device=self.device, num_workers=0)
         print(f'KID: {kid_score:.3f}')
         self.log(f"fid", fid_score, on_step=False, on_epoch=True, prog_bar=False, logger=True, rank_zero_only=True, sync_dist=True)
         self.log(f"kid", kid_score, on_step=False, on_epoch=True, prog_bar=False, logger=True, rank_zero_only=True, sync_dist=True)
-        shutil.rmtree(odir_real.parent)
 
     def get_mapped_latent(self, z, style_mixing_prob):
-        if torch.rand(()).item() < style_mixing_prob:
-            cross_over_point = int(torch.rand(()).item() * self.G.mapping.num_ws)
-            w1 = self.G.mapping(z[0])[:, :cross_over_point, :]
-            w2 = self.G.mapping(z[1], skip_w_avg_update=True)[:, cross_over_point:, :]
-            return torch.cat((w1, w2), dim=1)
+        if random.random() < style_mixing_prob:
+            cross_over_point = int(random.random() * self.G.mapping.num_ws)
+            w = self.G.mapping(torch.cat(z, dim=0), w_avg_batch_size=z[0].shape[0])
+            w1, w2 = w.chunk(2, dim=0)
+            return torch.cat((w1[:, :cross_over_point, :], w2[:, cross_over_point:, :]), dim=1)
         else:
             w = self.G.mapping(z[0])
             return w
@@ -280,32 +314,47 @@ class StyleGAN2Trainer(pl.LightningModule):
         batch['shape'] = code
 
     def train_dataloader(self):
-        return GraphDataLoader(self.train_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, num_workers=self.config.num_workers)
+        return GraphDataLoader(self.train_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, **self.get_worker_kwargs())
 
     def val_dataloader(self):
-        return GraphDataLoader(self.val_set, self.config.batch_size, shuffle=True, drop_last=True, num_workers=self.config.num_workers)
+        if self.val_loader is None:
+            self.val_loader = GraphDataLoader(self.val_set, self.config.batch_size, shuffle=True, pin_memory=True, drop_last=True, **self.get_worker_kwargs())
+        return self.val_loader
+
+    def get_worker_kwargs(self):
+        if self.config.num_workers == 0:
+            return {'num_workers': 0}
+        return {'num_workers': self.config.num_workers, 'persistent_workers': True}
 
     def export_grid(self, prefix, output_dir_vis, output_dir_fid):
-        vis_generated_images = []
-        grid_loader = iter(GraphDataLoader(self.train_set, batch_size=self.config.batch_size))
-        for iter_idx, z in enumerate(self.grid_z.split(self.config.batch_size)):
+        latents = self.grid_z.split(self.config.batch_size)
+        num_vis_batches = min(self.config.num_vis_images // self.config.batch_size, len(latents))
+        vis_generated_images = None
+        if self.grid_loader is None:
+            self.grid_loader = GraphDataLoader(self.train_set, batch_size=self.config.batch_size, pin_memory=True, **self.get_worker_kwargs())
+        grid_loader = iter(self.grid_loader)
+        for iter_idx, z in enumerate(latents):
+            if output_dir_fid is None and iter_idx >= num_vis_batches:
+                break
             z = z.to(self.device)
             eval_batch = to_device(next(grid_loader), self.device)
             self.set_shape_codes(eval_batch)
             fake = self.render(self.G(eval_batch['graph_data'], z, eval_batch['shape'], noise_mode='const'), eval_batch, use_bg_color=False)
-            fake = torch.nn.functional.interpolate(fake[:, :3, :, :], size=(self.config.image_size, self.config.image_size), mode='bilinear', align_corners=False).cpu()
+            fake = self.resize_render(fake).cpu()
             fake = self.train_set.cspace_convert_back(fake)
             if output_dir_fid is not None:
-                for batch_idx in range(fake.shape[0]):
-                    save_image(fake[batch_idx], output_dir_fid / f"{iter_idx}_{batch_idx}.jpg", value_range=(-1, 1), normalize=True)
-            if iter_idx < self.config.num_vis_images // self.config.batch_size:
-                vis_generated_images.append(fake)
-        torch.cuda.empty_cache()
-        vis_generated_images = torch.cat(vis_generated_images, dim=0)
+                save_jpegs(fake, [output_dir_fid / f"{iter_idx}_{batch_idx}.jpg" for batch_idx in range(fake.shape[0])])
+            if iter_idx < num_vis_batches:
+                if vis_generated_images is None:
+                    # renders are per view, so the grid is sized from the first batch
+                    vis_generated_images = torch.empty((num_vis_batches * fake.shape[0], *fake.shape[1:]))
+                vis_generated_images[iter_idx * fake.shape[0]: (iter_idx + 1) * fake.shape[0]] = fake
         save_image(vis_generated_images, output_dir_vis / f"{prefix}{self.global_step:06d}.png", nrow=int(math.sqrt(vis_generated_images.shape[0])), value_range=(-1, 1), normalize=True)
 
     def export_mesh(self, outdir):
-        grid_loader = iter(GraphDataLoader(self.train_set, batch_size=self.config.batch_size, shuffle=True))
+        if self.mesh_loader is None:
+            self.mesh_loader = GraphDataLoader(self.train_set, batch_size=self.config.batch_size, shuffle=True, pin_memory=True, **self.get_worker_kwargs())
+        grid_loader = iter(self.mesh_loader)
         for iter_idx, z in enumerate(self.grid_z.split(self.config.batch_size)):
             if iter_idx < self.config.num_vis_meshes // self.config.batch_size:
                 z = z.to(self.device)
@@ -323,51 +372,72 @@ class StyleGAN2Trainer(pl.LightningModule):
         output_dir_samples = Path(f'runs/{self.config.experiment}/images/{self.global_step:06d}')
         output_dir_textures = Path(f'runs/{self.config.experiment}/textures/')
         output_dir_meshes = Path(f'runs/{self.config.experiment}/meshes//{self.global_step:06d}')
+        if not self.fid_dirs_cleared:
+            # fid images keep fixed names and counts across validations and are overwritten in place, so the tree is only cleared once per run
+            shutil.rmtree(output_dir_fid_real.parent, ignore_errors=True)
+            self.fid_dirs_cleared = True
         for odir in [output_dir_fid_real, output_dir_fid_fake, output_dir_samples, output_dir_textures, output_dir_meshes]:
             odir.mkdir(exist_ok=True, parents=True)
         return output_dir_fid_real, output_dir_fid_fake, output_dir_samples, output_dir_textures, output_dir_meshes
 
     def on_train_start(self):
         if self.ema is None:
-            self.ema = ExponentialMovingAverage(self.G.parameters(), 0.995)
+            self.ema = ExponentialMovingAverage(self.g_params, 0.995)
         if self.R is None:
             self.R = DifferentiableRenderer(self.config.image_size_hres, "bounds", self.config.colorspace, num_channels=4)
+        if self.config.compile and self.compiled_D is None:
+            self.compiled_D = torch.compile(self.D.forward)
+            self.compiled_augment_pipe = torch.compile(self.augment_pipe.forward)
+            self.compiled_patch_D = torch.compile(self.patch_D.forward)
 
     def on_validation_start(self):
         if self.ema is None:
-            self.ema = ExponentialMovingAverage(self.G.parameters(), 0.995)
+            self.ema = ExponentialMovingAverage(self.g_params, 0.995)
         if self.R is None:
             self.R = DifferentiableRenderer(self.config.image_size_hres, "bounds", self.config.colorspace, num_channels=4)
 
     @staticmethod
-    def extract_patches_from_tensor(t_image, mask, patches_per_view, patch_size):
-        patches = []
-        for idx in range(t_image.shape[0]):
-            nonzero_y, nonzero_x = torch.nonzero(mask[idx] > 0, as_tuple=True)
-            y_min, y_max = nonzero_y.min(), nonzero_y.max()
-            x_min, x_max = nonzero_x.min(), nonzero_x.max()
-            nz_m0 = torch.logical_and(nonzero_y > (y_min + patch_size // 2 + 1), nonzero_y < (y_max - patch_size // 2 - 1))
-            nz_m1 = torch.logical_and(nonzero_x > (x_min + patch_size // 2 + 1), nonzero_x < (x_max - patch_size // 2 - 1))
-            nz_mask = torch.logical_and(nz_m0, nz_m1)
-            nonzero_y = nonzero_y[nz_mask]
-            nonzero_x = nonzero_x[nz_mask]
-            sampled_idx = random.sample(list(range(nonzero_y.shape[0])), patches_per_view)
-            y = nonzero_y[sampled_idx]
-            x = nonzero_x[sampled_idx]
-            for p in range(patches_per_view):
-                y_low, y_high = y[p] - patch_size // 2, y[p] + patch_size // 2
-                x_low, x_high = x[p] - patch_size // 2, x[p] + patch_size // 2
-                patch = t_image[idx, :, y_low: y_high, x_low: x_high]
-                patches.append(patch.unsqueeze(0))
-        patches = torch.cat(patches, dim=0).reshape((t_image.shape[0], patches_per_view, 3, patch_size, patch_size))
-        return patches
-
-
-def step(opt, module):
-    for param in module.parameters():
-        if param.grad is not None:
-            torch.nan_to_num(param.grad, nan=0, posinf=1e5, neginf=-1e5, out=param.grad)
-    torch.nn.utils.clip_grad_norm_(module.parameters(), 1)
+    def extract_patches_from_tensor(t_image, mask, patches_per_view, patch_size, num_samples):
+        # patch centers are drawn on the device among the mask pixels whose patch stays inside the mask's bounding box
+        batch_size, _, height, width = t_image.shape
+        half_size = patch_size // 2
+        valid = mask > 0
+        rows, cols = valid.any(dim=2).float(), valid.any(dim=1).float()
+        y_min, y_max = rows.argmax(dim=1), height - 1 - rows.flip(1).argmax(dim=1)
+        x_min, x_max = cols.argmax(dim=1), width - 1 - cols.flip(1).argmax(dim=1)
+        ys = torch.arange(height, device=mask.device).unsqueeze(0)
+        xs = torch.arange(width, device=mask.device).unsqueeze(0)
+        valid_y = torch.logical_and(ys > (y_min + half_size + 1).unsqueeze(1), ys < (y_max - half_size - 1).unsqueeze(1))
+        valid_x = torch.logical_and(xs > (x_min + half_size + 1).unsqueeze(1), xs < (x_max - half_size - 1).unsqueeze(1))
+        candidates = valid & valid_y.unsqueeze(2) & valid_x.unsqueeze(1)
+        centers = torch.multinomial(candidates.reshape(batch_size, -1).float(), patches_per_view)
+        y, x = torch.div(centers, width, rounding_mode='floor'), centers % width
+        offsets = torch.arange(-half_size, half_size, device=mask.device)
+        patch_y = (y.unsqueeze(2) + offsets).unsqueeze(3)
+        patch_x = (x.unsqueeze(2) + offsets).unsqueeze(2)
+        batch_idx = torch.arange(batch_size, device=mask.device).reshape((batch_size, 1, 1, 1))
+        # one gather for all crops, indexed as (batch, patch, y, x, channel)
+        patches = t_image[batch_idx, :, patch_y, patch_x]
+        # the crops of a sample are stacked along the channels in (view, patch, channel) order, written once in channels_last layout
+        patches = patches.reshape((num_samples, -1) + patches.shape[1:]).permute((0, 3, 4, 1, 2, 5)).reshape((num_samples, patch_size, patch_size, -1))
+        return patches.permute((0, 3, 1, 2))
+
+
+@torch.jit.script
+def nan_to_num_clip_(tensors: List[torch.Tensor], max_norm: float):
+    for t in tensors:
+        t.nan_to_num_(nan=0., posinf=1e5, neginf=-1e5)
+    if len(tensors) > 0:
+        # same as clip_grad_norm_, but the coefficient is clamped on the device instead of compared on the host
+        total_norm = torch.norm(torch.stack([torch.norm(t) for t in tensors]))
+        clip_coef = torch.clamp((total_norm + 1e-6).reciprocal() * max_norm, max=1.0)
+        for t in tensors:
+            t.mul_(clip_coef)
+
+
+def step(opt, params):
+    # the grads are gathered once for both the sanitizing and the clipping
+    nan_to_num_clip_([param.grad for param in params if param.grad is not None], 1.)
     opt.step()
 
 
@@ -1,6 +1,8 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
+import torchvision
 from ballpark import business
 import numpy as np
 from cleanfid import fid
@@ -121,3 +123,25 @@ def compute_fid(output_dir_fake, output_dir_real, filepath, device):
     print(f'KID: {kid_score:.3f}')
     Path(filepath).write_text(f"fid = {fid_score}\nkid = {kid_score}")
 
+
+def quantize_images(images, value_range=(-1, 1)):
+    # same normalization as save_image(normalize=True), done for the whole batch on the tensor's device
+    low, high = value_range
+    return ((images.clamp(low, high) - low) / (high - low)).mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+
+
+def write_jpegs(images, paths, num_threads=8):
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(lambda args: torchvision.io.write_jpeg(args[0], str(args[1])), zip(images.cpu(), paths)))
+
+
+def save_jpegs(images, paths, value_range=(-1, 1)):
+    write_jpegs(quantize_images(images, value_range), paths)
+
+
+def compute_fid_kid(output_dir_real, output_dir_fake, device):
+    # one inception model and one feature pass per folder shared by both metrics, fid.compute_fid and fid.compute_kid each redo all of it
+    model = fid.build_feature_extractor("clean", device)
+    feats_real, feats_fake = [fid.get_folder_features(str(output_dir), model, num_workers=0, batch_size=32, device=device, mode="clean", description=f"{output_dir.name} : ")
+                              for output_dir in (output_dir_real, output_dir_fake)]
+    return fid.fid_from_feats(feats_real, feats_fake), fid.kernel_distance(feats_real, feats_fake)